@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+
+import argparse
+import gc
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import gopherlib
+
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__.replace("bench_", "")] = function
+    return function
+
+
+def best_of(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def allocated(function, *args):
+    gc.collect()
+    tracemalloc.start()
+
+    result = function(*args)
+    size, _ = tracemalloc.get_traced_memory()
+
+    tracemalloc.stop()
+    del result
+
+    return size
+
+
+def make_rows(count):
+    hosts = [f"gopher{i}.example.org" for i in range(8)]
+    kinds = [
+        ("i", "", "fake", "(NULL)", "0"),
+        ("1", "Directory", "/dir/{}", None, "70"),
+        ("0", "Text file", "/txt/{}.txt", None, "70"),
+        ("I", "Image", "/img/{}.jpg", None, "70"),
+        ("9", "Binary", "/bin/{}.tar.gz", None, "70"),
+        ("h", "Link", "URL:https://example.org/{}", None, "70"),
+    ]
+
+    rows = []
+    for i in range(count):
+        type, text, url, host, port = kinds[i % len(kinds)]
+        rows.append([
+            f"{type}{text} {i}", url.format(i), host or hosts[i % len(hosts)], port])
+
+    return rows
+
+
+class LegacyLine:
+    def __init__(self, type, text, location):
+        self.type = type
+        self.text = text
+        self.location = location
+
+
+class LegacyLocation:
+    def __init__(self, host, port, url, focus=0, walkable=True,
+                 bookmarks=False, history=False):
+
+        self.host = host
+        self.port = int(port) if port else 70
+        self.url = url
+
+        self.focus = focus
+        self.walkable = walkable
+
+        self.bookmarks = bookmarks
+        self.history = history
+
+
+def legacy_parse(rows):
+    lines = []
+    for line in rows:
+        text = line[0] if len(line) > 0 else ""
+        url = line[1] if len(line) > 1 else ""
+        host = line[2] if len(line) > 2 else ""
+        try:
+            port = int(line[3]) if len(line) > 3 else 70
+
+        except Exception:
+            port = 70
+
+        line_type = "inf"
+        if len(text) > 0:
+            line_type = gopherlib.TYPE_MAP.get(text[0], "inf")
+            text = text[1:]
+
+        lines.append(LegacyLine(line_type, text, LegacyLocation(host, port, url)))
+
+    # ContentWindow used to classify every row while building its widgets
+    for line in lines:
+        line.type in gopherlib.SELECTABLES
+        gopherlib.is_image(line.location.url)
+
+    return lines
+
+
+@benchmark
+def bench_menu(arguments):
+    rows = make_rows(arguments.rows)
+
+    print(f"menu: parse and classify {len(rows)} rows (best of {arguments.repeat})")
+
+    for name, parse in [
+        ("list of Line", lambda: legacy_parse(rows)),
+        ("Menu", lambda: gopherlib.Menu(rows)),
+    ]:
+        elapsed = best_of(arguments.repeat, parse)
+        size = allocated(parse)
+
+        print(
+            f"  {name:<14} {elapsed * 1000:8.1f} ms"
+            f"  {elapsed * 1e9 / len(rows):8.0f} ns/row"
+            f"  {size / len(rows):6.0f} B/row")
+
+
+def make_menu(size, encoding):
+    rows = []
+    length = 0
+    i = 0
+    while length < size:
+        if encoding == "cp437" and i % 10 == 0:
+            row = "i╔══════════════╗\tfake\t(NULL)\t0\r\n"
+
+        elif encoding == "latin-1" and i % 10 == 0:
+            row = f"iÉté à Montréal {i}\tfake\t(NULL)\t0\r\n"
+
+        else:
+            row = f"1Directory {i} — menu\t/dir/{i}\tgopher.example.org\t70\r\n"
+
+        row = row.encode("utf-8" if encoding == "utf-8" or i % 10 else encoding)
+        rows.append(row)
+        length += len(row)
+        i += 1
+
+    rows.append(b".\r\n")
+    return b"".join(rows)
+
+
+def legacy_split(data, chunk_size):
+    rows = []
+    remainder = b""
+    for start in range(0, len(data), chunk_size):
+        lines = (remainder + data[start:start + chunk_size]).split(b"\n")
+        remainder = lines.pop()
+        rows.extend(line.decode(errors="replace").split("\t") for line in lines)
+
+    if remainder:
+        rows.append(remainder.decode(errors="replace").split("\t"))
+
+    return rows
+
+
+def menu_parser(data, chunk_size):
+    parser = gopherlib.MenuParser()
+    rows = []
+    for start in range(0, len(data), chunk_size):
+        rows.extend(parser.feed(data[start:start + chunk_size]))
+
+    rows.extend(parser.close())
+    return rows
+
+
+@benchmark
+def bench_parser(arguments):
+    size = int(arguments.size * 1024 * 1024)
+    chunk_size = gopherlib.STREAM_CHUNK_SIZE
+
+    print(f"parser: split and decode a {arguments.size:g} MB menu (best of {arguments.repeat})")
+
+    for encoding in ["utf-8", "latin-1", "cp437"]:
+        data = make_menu(size, encoding)
+
+        for name, parse in [
+            ("split/replace", lambda: legacy_split(data, chunk_size)),
+            ("MenuParser", lambda: menu_parser(data, chunk_size)),
+        ]:
+            elapsed = best_of(arguments.repeat, parse)
+
+            print(
+                f"  {encoding:<8} {name:<14} {elapsed * 1000:8.1f} ms"
+                f"  {len(data) / elapsed / 1024 / 1024:8.1f} MB/s")
+
+
+@benchmark
+def bench_bookmarks(arguments):
+    import pherguson
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = pherguson.BookmarkStore(directory)
+        hosts = [f"gopher{i}.example.org" for i in range(50)]
+
+        with open(store.path, "w") as file:
+            for i in range(arguments.bookmarks):
+                file.write(f"1Bookmark {i} about phlogs\t/users/{i}/phlog\t{hosts[i % len(hosts)]}\t70\n")
+
+        elapsed = best_of(1, store.load)
+        print(f"bookmarks: load and index {arguments.bookmarks} bookmarks {elapsed * 1000:.1f} ms")
+
+        query = "gopher7phlog"
+        print(f"  typing {query!r}, filter and build the menu per keystroke (best of {arguments.repeat})")
+
+        worst = 0
+        for length in range(1, len(query) + 1):
+            elapsed = None
+            for _ in range(arguments.repeat):
+                # the store narrows from the previous keystroke
+                store.filter(query[:length - 1])
+
+                start = time.perf_counter()
+                gopherlib.Menu().extend_from(store.menu, store.filter(query[:length]))
+                keystroke = time.perf_counter() - start
+
+                elapsed = keystroke if elapsed is None else min(elapsed, keystroke)
+
+            worst = max(worst, elapsed)
+            print(f"  {query[:length]!r:<16} {len(store.matches):6d} matches {elapsed * 1000:8.2f} ms")
+
+        print(f"  slowest keystroke {worst * 1000:.2f} ms")
+
+
+@benchmark
+def bench_search(arguments):
+    menu = gopherlib.Menu(make_rows(arguments.rows))
+
+    elapsed = best_of(1, menu.text_index)
+    print(f"search: index {len(menu)} menu rows {elapsed * 1000:.1f} ms")
+
+    query = "binary 99999"
+    print(f"  typing {query!r}, search from the top per keystroke (best of {arguments.repeat})")
+
+    worst = 0
+    for length in range(1, len(query) + 1):
+        elapsed = best_of(arguments.repeat, menu.find, query[:length], 0)
+        worst = max(worst, elapsed)
+
+        print(f"  {query[:length]!r:<16} line {menu.find(query[:length], 0)!s:>7} {elapsed * 1000:8.2f} ms")
+
+    elapsed = best_of(arguments.repeat, menu.find, "not in the menu", 0)
+    worst = max(worst, elapsed)
+
+    print(f"  {'no match':<16} {'':12} {elapsed * 1000:8.2f} ms")
+    print(f"  slowest keystroke {worst * 1000:.2f} ms")
+
+
+def search_queries(index, repeat):
+    for query in ["gopher1", "phlog7 modem3", "ascii1999 week", "week", "the gopher", "nothing"]:
+        elapsed = best_of(repeat, index.search, query)
+        print(f"    {query!r:<20} {len(index.search(query)):4d} results {elapsed * 1000:8.2f} ms")
+
+
+@benchmark
+def bench_fulltext(arguments):
+    import pherguson
+
+    words = [f"{syllable}{i}" for i in range(2000) for syllable in ["gopher", "phlog", "ascii", "modem"]]
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = pherguson.SearchIndex(directory)
+
+        start = time.perf_counter()
+        for i in range(arguments.pages):
+            rows = [[f"i{' '.join(random.choices(words, k=8))}", "fake", "(NULL)", "0"] for _ in range(40)]
+            rows.append(["iThe gopher hole of the week", "fake", "(NULL)", "0"])
+            rows.append([f"1Next page {i + 1}", f"/page/{i + 1}", "gopher.example.org", "70"])
+            index.add(gopherlib.Location("gopher.example.org", 70, f"/page/{i}"), rows)
+
+        # returns once the writer thread has indexed everything
+        index.close()
+        elapsed = time.perf_counter() - start
+
+        index = pherguson.SearchIndex(directory)
+        size = os.path.getsize(index.database)
+
+        print(f"fulltext: index {arguments.pages} pages {elapsed:.1f} s, {size / 1024 / 1024:.1f} MB")
+        print(f"  queries before compaction (best of {arguments.repeat})")
+        search_queries(index, arguments.repeat)
+
+        elapsed = best_of(1, index._compact, index.connection, arguments.pages)
+        print(f"  queries after compaction ({elapsed:.1f} s)")
+        search_queries(index, arguments.repeat)
+
+        index.close()
+
+
+@benchmark
+def bench_keypress(arguments):
+    import pherguson
+
+    from types import SimpleNamespace
+
+    # just enough of a Gopher for a ContentWindow and its StatusBar
+    gopher = SimpleNamespace(
+        redraw=lambda: None, rendered=lambda seconds: None,
+        prefetcher=None, thumbnail_generator=None)
+    gopher.status_bar = pherguson.StatusBar(gopher)
+    window = pherguson.ContentWindow(gopher)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # the page the cursor moves on, visited in a history of its own
+        pherguson.history = pherguson.History(directory)
+        pherguson.history.forward(gopherlib.Location("example.org", 70, "/"))
+
+        gopher.current_location_map = gopherlib.Menu(make_rows(arguments.keypress_rows))
+        window.set_content(gopher.current_location_map, 0)
+        window.finish_content()
+
+        size = (120, 40)
+        # the screen keeps the last canvas, which lets urwid reuse the rows that did not change
+        canvases = [window.render(size, True)]
+
+        print(f"keypress: move the cursor on a {arguments.keypress_rows} line menu (best of {arguments.repeat})")
+
+        def move(keys, render):
+            for key in keys:
+                window.keypress(size, key)
+                if render:
+                    canvases[0] = window.render(size, True)
+
+        keys = ["j"] * 1000 + ["k"] * 1000
+        for name, render in [("keypress", False), ("keypress+render", True)]:
+            elapsed = best_of(arguments.repeat, move, keys, render)
+
+            print(
+                f"  {name:<16} {len(keys) / elapsed:10.0f} keys/s"
+                f"  {elapsed * 1e6 / len(keys):8.1f} us/key")
+
+        pherguson.history.store.close()
+
+
+# runs in a fresh interpreter: imports pherguson, starts it on a screen that draws
+# nowhere and reports how long the first frame took
+STARTUP_SCRIPT = """
+import os, sys, time
+
+started, mode, url = float(sys.argv[1]), sys.argv[2], sys.argv[3]
+
+import pherguson
+imported = time.monotonic()
+
+import json
+
+if mode == "seed":
+    pherguson.Cache().store_menu(pherguson.parse_url(url), [["iHello"], ["1Menu", "/menu", "example.org", "70"]])
+    sys.exit(0)
+
+import urwid
+
+class Screen(urwid.raw_display.Screen):
+    def start(self, *args, **kwargs):
+        self._started = True
+
+    def stop(self):
+        pass
+
+    def set_mouse_tracking(self, enable=True):
+        pass
+
+    def get_cols_rows(self):
+        return 120, 40
+
+    def hook_event_loop(self, event_loop, callback):
+        pass
+
+    def unhook_event_loop(self, event_loop):
+        pass
+
+    def signal_init(self):
+        pass
+
+    def signal_restore(self):
+        pass
+
+    def draw_screen(self, size, canvas):
+        print(json.dumps({
+            "imported": imported - started,
+            "frame": time.monotonic() - started,
+            "text": [line.decode("utf-8", "replace").strip() for line in canvas.text[2:-2] if line.strip()][:1]
+                    + [canvas.text[-1].decode("utf-8", "replace").strip()],
+            "modules": [name for name in ["requests", "PIL", "ueberzug"] if name in sys.modules],
+        }))
+        sys.stdout.flush()
+        os._exit(0)
+
+pherguson.main([url, "--offline"] if mode == "offline" else [url], screen=Screen())
+"""
+
+
+def start_pherguson(mode, url, home, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else [])
+    command += ["-c", STARTUP_SCRIPT, str(time.monotonic()), mode, url]
+
+    result = subprocess.run(
+        command, capture_output=True, text=True, timeout=60,
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ, HOME=home))
+
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    report = json.loads(result.stdout) if mode != "seed" else {}
+    return report, result.stderr
+
+
+def import_times(output):
+    # -X importtime: "import time: self [us] | cumulative | imported package", nested
+    # imports are indented by two spaces per level and listed before what imported them
+    modules = []
+    children = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+
+        if depth == 1:
+            children.append((int(cumulative) / 1000, name.strip()))
+
+        elif depth == 0:
+            modules.append((int(cumulative) / 1000, name.strip(), sorted(children, reverse=True)))
+            children = []
+
+    return sorted(modules, reverse=True)
+
+
+@benchmark
+def bench_startup(arguments):
+    # a server that accepts connections and never answers: nothing may wait on it
+    server = socket.create_server(("127.0.0.1", 0))
+    url = f"127.0.0.1:{server.getsockname()[1]}/"
+
+    print(f"startup: launch to first frame, with a start page that never loads (best of {arguments.repeat})")
+
+    with server, tempfile.TemporaryDirectory() as home:
+        for name, mode in [("not cached", "online"), ("cached", "online"), ("offline", "offline")]:
+            if name == "cached":
+                start_pherguson("seed", url, home)
+
+            reports = [start_pherguson(mode, url, home)[0] for _ in range(arguments.repeat)]
+            best = min(reports, key=lambda report: report["frame"])
+
+            print(
+                f"  {name:<12} import {best['imported'] * 1000:6.1f} ms"
+                f"  first frame {best['frame'] * 1000:6.1f} ms"
+                f"  {' / '.join(best['text'])[:50]!r}")
+
+        print(f"  loaded before the first frame: {', '.join(best['modules']) or 'none of requests, PIL, ueberzug'}")
+
+        _, output = start_pherguson("online", url, home, importtime=True)
+
+    modules = import_times(output)
+    print(
+        f"  imports (-X importtime, cumulative, total {sum(ms for ms, _, _ in modules):.1f} ms), "
+        f"the slowest with what they import first")
+
+    for ms, name, children in modules[:3]:
+        print(f"    {name:<28} {ms:8.1f} ms")
+
+        for ms, name in children[:arguments.imports]:
+            print(f"      {name:<26} {ms:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmark")
+    parser.add_argument(
+        "benchmarks", nargs="*", metavar="benchmark",
+        help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument(
+        "--rows", type=int, default=100000,
+        help="menu rows to generate (default: 100000)")
+    parser.add_argument(
+        "--size", type=float, default=10,
+        help="menu size in MB for the parser benchmark (default: 10)")
+    parser.add_argument(
+        "--bookmarks", type=int, default=10000,
+        help="bookmarks to generate for the bookmarks benchmark (default: 10000)")
+    parser.add_argument(
+        "--pages", type=int, default=20000,
+        help="pages to index for the fulltext benchmark (default: 20000)")
+    parser.add_argument(
+        "--keypress-rows", type=int, default=50000,
+        help="menu rows for the keypress benchmark (default: 50000)")
+    parser.add_argument(
+        "--imports", type=int, default=12,
+        help="slowest imports listed by the startup benchmark (default: 12)")
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="runs per measurement, the best one is reported (default: 5)")
+
+    arguments = parser.parse_args()
+
+    for name in arguments.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    for name in arguments.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](arguments)
+
+
+if __name__ == "__main__":
+    main()
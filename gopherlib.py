@@ -0,0 +1,1199 @@
+#!/usr/bin/env python
+
+import argparse
+import array
+import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import time
+
+from urllib.parse import unquote, urlparse
+
+SOCKET_TIMEOUT = 10
+STREAM_CHUNK_SIZE = 64 * 1024
+# C1 control codes and runs of box drawing characters are common in cp437 art,
+# but unlikely in latin-1 text
+CP437_BYTES = re.compile(rb"[\x80-\x9f]|[\xb0-\xdf]{3}")
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PROGRESS_INTERVAL = 0.25
+DOWNLOAD_WORKERS = 4
+DUMP_FORMATS = ["tsv", "json"]
+MIRROR_DEPTH = 10
+MIRROR_PER_HOST = 2
+MIRROR_DELAY = 0.5
+MIRROR_SCOPES = ["host", "selector", "any"]
+MIRROR_STATE_FILE = ".pherguson-mirror"
+MIRROR_MENU_FILE = "gophermap"
+
+TYPE_MAP = {
+    # canonical types
+    "0": "txt",  # text file
+    "1": "dir",  # submenu
+    "2": "cns",  # CCSO Nameserver
+    "3": "err",  # Error
+    "4": "hex",  # Error
+    "5": "dos",  # DOS file
+    "6": "utf",  # uuencoded file
+    "7": "ask",  # full text search
+    "8": "tnt",  # telnet
+    "9": "bin",  # binary file
+    "+": "mir",  # mirror
+    "g": "gif",  # gif file
+    "I": "img",  # image file
+    "T": "tn3",  # telnet 3270
+    # non-canonical types
+    "d": "doc",  # pdf / .doc
+    "h": "htm",  # html file / link
+    "i": "inf",  # info message
+    "p": "png",  # image file
+    "r": "rtf",  # rft file
+    "s": "snd",  # sound file
+    ";": "vid",  # video file
+    "P": "pdf",  # pdf file
+    "X": "xml",  # xml file
+}
+SELECTABLES = ["txt", "dir", "gif", "htm", "img", "gif", "ask",
+               "bin", "png", "rtf", "snd", "vid", "pdf", "xml", "hex"]
+BINARIES = ["txt", "hex", "img", "gif", "bin", "png", "rtf", "pdf", "xml"]
+# searches, telnet sessions and http links have nothing to save
+UNMIRRORED = ["inf", "err", "cns", "ask", "tnt", "tn3", "htm", "mir"]
+
+LINE_TYPES = tuple(dict.fromkeys(TYPE_MAP.values()))
+LINE_TYPE_CODES = {char: LINE_TYPES.index(type) for char, type in TYPE_MAP.items()}
+# the first character of each type, to build links back from a menu
+LINE_TYPE_CHARS = {type: char for char, type in reversed(TYPE_MAP.items())}
+
+
+log = logging.getLogger("pherguson")
+log.addHandler(logging.NullHandler())
+log.propagate = False
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            break
+
+        size /= 1024
+
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def format_age(seconds):
+    for unit, length in [("d", 86400), ("h", 3600), ("m", 60)]:
+        if seconds >= length:
+            return f"{int(seconds // length)}{unit}"
+
+    return f"{int(seconds)}s"
+
+
+def decode_line(line):
+    try:
+        return str(line, "utf-8")
+
+    except UnicodeDecodeError:
+        pass
+
+    if CP437_BYTES.search(line):
+        return str(line, "cp437")
+
+    return str(line, "latin-1")
+
+
+@contextlib.contextmanager
+def atomic_write(file_path):
+    # a name no other writer has, created with the permissions of the umask
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+    while True:
+        temporary_path = f"{file_path}.{os.urandom(6).hex()}.part"
+        try:
+            descriptor = os.open(temporary_path, flags, 0o666)
+            break
+
+        except FileExistsError:
+            continue
+
+    try:
+        with open(descriptor, "wb") as file:
+            yield file
+
+        os.replace(temporary_path, file_path)
+
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temporary_path)
+
+        raise
+
+
+def is_image(url):
+    for image_type in ["jpg", "jpeg", "png", "gif"]:
+        if image_type in url.lower():
+            return True
+
+    return False
+
+
+def fetch_http(url, file_path, transfer, cancelled=None, progress=None, timing=None):
+    if timing is None:
+        timing = Timing("download", url, urlparse(url).netloc)
+
+    # only http links need it, and it is slow to import
+    import requests
+
+    # requests resolves and connects on its own, all of it counts as ttfb
+    with timing.stage("ttfb"):
+        response = requests.get(url, stream=True, timeout=SOCKET_TIMEOUT)
+
+    if response.status_code != 200:
+        raise Error(f"error downloading {url}: http {response.status_code}")
+
+    response.raw.decode_content = True
+
+    if "content-encoding" not in response.headers:
+        transfer.total = int(response.headers.get("content-length", 0)) or None
+
+    buffer = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+
+    with atomic_write(file_path) as file, timing.stage("xfer"):
+        while not (cancelled and cancelled.is_set()):
+            size = response.raw.readinto(buffer)
+            if not size:
+                break
+
+            file.write(buffer[:size])
+            if transfer.advance(size) and progress:
+                progress()
+
+        if cancelled and cancelled.is_set():
+            raise Error(f"cancelled: {url}")
+
+    timing.size = transfer.received
+    return file_path
+
+
+def fetch_gopher(location, file_path, transfer):
+    crlf = "\r\n"
+
+    try:
+        sock = socket.create_connection((location.host, location.port), timeout=SOCKET_TIMEOUT)
+
+    except OSError:
+        raise Error(f"error connecting to {location.host}:{location.port}")
+
+    buffer = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+
+    with sock, atomic_write(file_path) as file:
+        sock.sendall(str.encode(location.url) + str.encode(crlf))
+        sock.shutdown(socket.SHUT_WR)
+
+        while True:
+            size = sock.recv_into(buffer)
+            if not size:
+                break
+
+            file.write(buffer[:size])
+            transfer.advance(size)
+
+    return file_path
+
+
+class Transfer:
+    def __init__(self, name, total=None):
+        self.name = name
+        self.total = total
+        self.received = 0
+
+        self.started = time.monotonic()
+        self.finished = None
+        self.reported = 0
+
+    @property
+    def rate(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return self.received / elapsed if elapsed > 0 else 0
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def advance(self, size):
+        self.received += size
+
+        now = time.monotonic()
+        if now - self.reported < PROGRESS_INTERVAL:
+            return False
+
+        self.reported = now
+        return True
+
+    def __str__(self):
+        progress = format_size(self.received)
+        if self.total:
+            progress = f"{progress} / {format_size(self.total)}"
+
+        status = f"downloading: {self.name} {progress}, {format_size(self.rate)}/s"
+
+        if self.total and self.rate > 0:
+            eta = max(self.total - self.received, 0) / self.rate
+            status = f"{status}, eta {format_age(eta)}"
+
+        return status
+
+
+class Timing:
+    STAGES = ["dns", "conn", "ttfb", "xfer", "parse", "render"]
+
+    def __init__(self, kind, name, host):
+        self.kind = kind
+        self.name = name
+        self.host = host
+        self.size = 0
+
+        self.started = time.monotonic()
+        self.finished = None
+        self.stages = {}
+
+    @property
+    def total(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        started = time.monotonic()
+        try:
+            yield
+
+        finally:
+            self.add(stage, time.monotonic() - started)
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.monotonic()
+
+    def as_dict(self):
+        return {
+            "time": round(time.time(), 3),
+            "kind": self.kind,
+            "name": self.name,
+            "host": self.host,
+            "bytes": self.size,
+            "total_ms": round(self.total * 1000, 1),
+            **{f"{stage}_ms": round(self.stages[stage] * 1000, 1)
+               for stage in self.STAGES if stage in self.stages},
+        }
+
+    def __str__(self):
+        stages = " / ".join(
+            f"{stage} {self.stages[stage] * 1000:.0f}"
+            for stage in self.STAGES if stage in self.stages)
+
+        return f"{self.total * 1000:.0f} ms: {stages}"
+
+
+class Line:
+    __slots__ = ("type", "text", "location")
+
+    def __init__(self, type, text, location):
+        self.type = type
+        self.text = text
+        self.location = location
+
+    def __repr__(self):
+        return f"{self.type}\t{self.text}\t{self.location}\n"
+
+
+class Menu:
+    SELECTABLE = 1
+    BINARY = 2
+    IMAGE = 4
+
+    TYPES = LINE_TYPES
+    CODES = LINE_TYPE_CODES
+    INFO = LINE_TYPES.index("inf")
+
+    TYPE_FLAGS = bytearray(len(LINE_TYPES))
+    for code, type in enumerate(LINE_TYPES):
+        TYPE_FLAGS[code] = (
+            (SELECTABLE if type in SELECTABLES else 0) | (BINARY if type in BINARIES else 0))
+
+    del code, type
+
+    ROW_OVERHEAD = 128
+
+    __slots__ = (
+        "walkable", "codes", "flags", "texts", "urls", "hosts", "ports",
+        "search_index", "status_urls")
+
+    def __init__(self, rows=(), walkable=True):
+        self.walkable = walkable
+        self.search_index = None
+        self.status_urls = {}
+
+        self.codes = bytearray()
+        self.flags = bytearray()
+        self.texts = []
+        self.urls = []
+        self.hosts = []
+        self.ports = array.array("H")
+
+        self.extend(rows)
+
+    def extend(self, rows):
+        self.search_index = None
+
+        codes = self.codes
+        flags = self.flags
+        texts = self.texts
+        urls = self.urls
+        hosts = self.hosts
+        ports = self.ports
+
+        for row in rows:
+            fields = len(row)
+            text = row[0] if fields > 0 else ""
+            url = row[1] if fields > 1 else ""
+
+            code = self.INFO
+            if self.walkable and text:
+                code = self.CODES.get(text[0], self.INFO)
+                text = text[1:]
+
+            try:
+                port = int(row[3]) if fields > 3 else 70
+                ports.append(port)
+
+            except (ValueError, OverflowError):
+                ports.append(70)
+
+            flag = self.TYPE_FLAGS[code]
+            if is_image(url):
+                flag |= self.IMAGE
+
+            codes.append(code)
+            flags.append(flag)
+            texts.append(text)
+            urls.append(url)
+            hosts.append(sys.intern(row[2]) if fields > 2 else "")
+
+    def extend_from(self, menu, indexes):
+        # copies whole rows between columns, without parsing them again
+        self.search_index = None
+
+        self.codes.extend(bytes(map(menu.codes.__getitem__, indexes)))
+        self.flags.extend(bytes(map(menu.flags.__getitem__, indexes)))
+        self.texts.extend(map(menu.texts.__getitem__, indexes))
+        self.urls.extend(map(menu.urls.__getitem__, indexes))
+        self.hosts.extend(map(menu.hosts.__getitem__, indexes))
+        self.ports.extend(map(menu.ports.__getitem__, indexes))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        return Line(
+            self.TYPES[self.codes[index]], self.texts[index],
+            Location(self.hosts[index], self.ports[index], self.urls[index]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def type(self, index):
+        return self.TYPES[self.codes[index]]
+
+    def text(self, index):
+        return self.texts[index]
+
+    def status_url(self, index):
+        url = self.status_urls.get(index)
+
+        if url is None:
+            url = self.urls[index]
+            if "URL" in url:
+                url = url.replace("URL:", "")
+
+            else:
+                url = f"gopher://{self.hosts[index]}{url}"
+
+            self.status_urls[index] = url
+
+        return url
+
+    def is_selectable(self, index):
+        return self.flags[index] & self.SELECTABLE != 0
+
+    def is_binary(self, index):
+        return self.flags[index] & self.BINARY != 0
+
+    def is_image(self, index):
+        return self.flags[index] & self.IMAGE != 0
+
+    def text_index(self):
+        if self.search_index is None:
+            texts = self.texts
+            text = "\n".join(texts)
+            lowered = text.lower()
+
+            # a few characters grow when lowercased, which would shift the offsets
+            if len(lowered) != len(text):
+                texts = [text.lower() for text in texts]
+                lowered = "\n".join(texts)
+
+            # offset of each line in the joined text (its length plus a newline),
+            # and the end of the last one
+            starts = array.array("Q", itertools.accumulate(
+                map((1).__add__, map(len, texts)), initial=0))
+
+            self.search_index = (lowered, starts)
+
+        return self.search_index
+
+    def find(self, query, start=0, backward=False):
+        query = query.lower()
+        if not query or "\n" in query:
+            return None
+
+        text, starts = self.text_index()
+        offset = starts[min(max(start, 0), len(self))]
+
+        if backward:
+            position = text.rfind(query, 0, offset)
+            if position < 0:
+                position = text.rfind(query)
+
+        else:
+            position = text.find(query, offset)
+            if position < 0:
+                position = text.find(query)
+
+        if position < 0:
+            return None
+
+        return bisect.bisect_right(starts, position) - 1
+
+    def size(self):
+        return (
+            sum(map(len, self.texts)) + sum(map(len, self.urls))
+            + sum(map(len, set(self.hosts))) + len(self) * self.ROW_OVERHEAD
+        )
+
+
+class MenuParser:
+    def __init__(self):
+        self.remainder = b""
+        self.finished = False
+        self.utf8 = True
+
+    def feed(self, chunk):
+        if self.finished:
+            return []
+
+        data = self.remainder + chunk if self.remainder else chunk
+        end = data.rfind(b"\n") + 1
+
+        self.remainder = data[end:]
+        if not end:
+            return []
+
+        return self._rows(self._decode(data, end - 1))
+
+    def close(self):
+        data, self.remainder = self.remainder, b""
+        if self.finished or not data:
+            return []
+
+        return self._rows(self._decode(data, len(data)))
+
+    def _decode(self, data, end):
+        view = memoryview(data)
+
+        # fast path: the whole batch is valid utf-8, until a menu proves otherwise
+        if self.utf8:
+            try:
+                text = str(view[:end], "utf-8")
+                if "\r" in text:
+                    text = text.replace("\r\n", "\n")
+                    if text.endswith("\r"):
+                        text = text[:-1]
+
+                return text.split("\n")
+
+            except UnicodeDecodeError:
+                self.utf8 = False
+
+        return [
+            decode_line(line[:-1] if line.endswith(b"\r") else line)
+            for line in view[:end].tobytes().split(b"\n")
+        ]
+
+    def _rows(self, lines):
+        try:
+            del lines[lines.index("."):]
+            self.finished = True
+
+        except ValueError:
+            pass
+
+        return [line.split("\t") for line in lines]
+
+
+class Location:
+    __slots__ = ("host", "port", "url", "focus", "walkable", "bookmarks", "history", "search")
+
+    def __init__(self, host, port, url, focus=0, walkable=True,
+                 bookmarks=False, history=False, search=False):
+
+        self.host = host
+        self.port = int(port) if port else 70
+        self.url = url
+
+        self.focus = focus
+        self.walkable = walkable
+
+        self.bookmarks = bookmarks
+        self.history = history
+        self.search = search
+
+    def __repr__(self):
+        return f"gopher://{self.host}:{self.port}{self.url}"
+
+    def get_link(self, name=None):
+        url = "/" if self.url == "" else self.url
+        return (
+            f"{'1' if self.walkable else '0'}"
+            f"{name if name else url}\t{url}\t{self.host}\t{self.port}"
+        )
+
+
+class Error(Exception):
+    def __init__(self, message):
+        super(Error, self).__init__(message)
+        self.message = message
+
+
+async def _resolve(location, timing):
+    loop = asyncio.get_running_loop()
+
+    with timing.stage("dns"):
+        addresses = await asyncio.wait_for(
+            loop.getaddrinfo(location.host, location.port, type=socket.SOCK_STREAM),
+            timeout=SOCKET_TIMEOUT)
+
+    return [(family, address) for family, _, _, _, address in addresses]
+
+
+async def _connect(location, timing):
+    crlf = "\r\n"
+
+    loop = asyncio.get_running_loop()
+    sock = None
+
+    log.debug("connect %s:%s", location.host, location.port)
+
+    try:
+        addresses = await _resolve(location, timing)
+
+        with timing.stage("conn"):
+            for i, (family, address) in enumerate(addresses):
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+
+                try:
+                    await asyncio.wait_for(
+                        loop.sock_connect(sock, address), timeout=SOCKET_TIMEOUT)
+                    break
+
+                except (OSError, asyncio.TimeoutError):
+                    sock.close()
+                    if i == len(addresses) - 1:
+                        raise
+
+        await loop.sock_sendall(sock, str.encode(location.url) + str.encode(crlf))
+        sock.shutdown(socket.SHUT_WR)
+
+        return sock
+
+    except (ConnectionRefusedError, socket.gaierror, OSError, asyncio.TimeoutError) as e:
+        if sock is not None:
+            sock.close()
+
+        log.warning("connect %s:%s failed: %r", location.host, location.port, e)
+        raise Error(f"error connecting to {location.host}:{location.port}")
+
+    except BaseException:
+        if sock is not None:
+            sock.close()
+
+        raise
+
+
+async def _open_connection(location, timing):
+    sock = await _connect(location, timing)
+
+    try:
+        return await asyncio.open_connection(sock=sock)
+
+    except BaseException:
+        sock.close()
+        raise
+
+
+async def _read(location, stream):
+    try:
+        return await asyncio.wait_for(stream, timeout=SOCKET_TIMEOUT)
+
+    except (OSError, asyncio.TimeoutError) as e:
+        log.warning("read %s failed: %r", location, e)
+        raise Error(f"error reading from {location.host}:{location.port}")
+
+
+async def get_content(location, timing=None):
+    if timing is None:
+        timing = Timing("menu", str(location), location.host)
+
+    reader, writer = await _open_connection(location, timing)
+
+    parser = MenuParser()
+    try:
+        stage = "ttfb"
+        while not parser.finished:
+            with timing.stage(stage):
+                chunk = await _read(location, reader.read(STREAM_CHUNK_SIZE))
+
+            if not chunk:
+                break
+
+            stage = "xfer"
+            timing.size += len(chunk)
+
+            with timing.stage("parse"):
+                rows = parser.feed(chunk)
+
+            if rows:
+                yield rows
+
+        with timing.stage("parse"):
+            rows = parser.close()
+
+        if rows:
+            yield rows
+
+        log.debug("fetched %s: %s, %s", location, format_size(timing.size), timing)
+
+    finally:
+        writer.close()
+
+
+async def get_file(location, file_path, transfer=None, progress=None, timing=None):
+    if transfer is None:
+        transfer = Transfer(str(location))
+
+    if timing is None:
+        timing = Timing("download", str(location), location.host)
+
+    loop = asyncio.get_running_loop()
+    sock = await _connect(location, timing)
+
+    buffer = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+
+    try:
+        with atomic_write(file_path) as file:
+            stage = "ttfb"
+            while True:
+                with timing.stage(stage):
+                    size = await _read(location, loop.sock_recv_into(sock, buffer))
+
+                if not size:
+                    break
+
+                stage = "xfer"
+                file.write(buffer[:size])
+                if transfer.advance(size) and progress:
+                    progress()
+
+    finally:
+        sock.close()
+
+    timing.size = transfer.received
+    return file_path
+
+
+def parse_url(url):
+    if "://" not in url:
+        url = f"gopher://{url}"
+
+    parsed_url = urlparse(url)
+    if parsed_url.scheme != "gopher" or not parsed_url.hostname:
+        raise Error(f"not a gopher url: {url}")
+
+    try:
+        port = parsed_url.port or 70
+
+    except ValueError:
+        raise Error(f"not a gopher url: {url}")
+
+    # gopher://host/1/selector names the item type before the selector
+    selector = unquote(parsed_url.path)
+    walkable = True
+    if len(selector) > 1 and selector[1] in TYPE_MAP and selector[2:3] in ["", "/"]:
+        walkable = TYPE_MAP[selector[1]] not in BINARIES
+        selector = selector[2:]
+
+    if parsed_url.query:
+        selector = f"{selector}\t{unquote(parsed_url.query)}"
+
+    return Location(parsed_url.hostname, port, selector, walkable=walkable)
+
+
+def link(menu, index):
+    type = menu.type(index)
+    url = menu.urls[index]
+
+    if type == "inf":
+        return ""
+
+    if url.startswith("URL:"):
+        return url[4:]
+
+    return format_url(menu.hosts[index], menu.ports[index], LINE_TYPE_CHARS[type], url)
+
+
+def format_url(host, port, char, selector):
+    return f"gopher://{host}{'' if port == 70 else f':{port}'}/{char}{selector}"
+
+
+async def _get_rows(location):
+    rows = []
+    async for content in get_content(location):
+        rows.extend(content)
+
+    return rows
+
+
+def _location(url):
+    return url if isinstance(url, Location) else parse_url(url)
+
+
+def fetch_menu(url):
+    location = _location(url)
+    return Menu(asyncio.run(_get_rows(location)), location.walkable)
+
+
+def fetch_text(url):
+    location = _location(url)
+    rows = asyncio.run(_get_rows(location))
+
+    return "\n".join("\t".join(row) for row in rows)
+
+
+def download(url, file_path, transfer=None):
+    if transfer is None:
+        transfer = Transfer(str(url))
+
+    if isinstance(url, str) and url.startswith(("http://", "https://")):
+        return fetch_http(url, file_path, transfer)
+
+    return fetch_gopher(_location(url), file_path, transfer)
+
+
+def download_all(urls, directory, workers=DOWNLOAD_WORKERS):
+    os.makedirs(directory, exist_ok=True)
+
+    # files with the same name get a numbered suffix instead of overwriting each other
+    paths = {}
+    names = set()
+    for url in dict.fromkeys(urls):
+        name = os.path.basename(urlparse(url).path.rstrip("/")) or "index"
+        stem, extension = os.path.splitext(name)
+
+        number = 0
+        while name.lower() in names:
+            number += 1
+            name = f"{stem}-{number}{extension}"
+
+        names.add(name.lower())
+        paths[url] = os.path.join(directory, name)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download, url, file_path): url for url, file_path in paths.items()}
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+
+            except (Error, OSError) as e:
+                yield futures[future], None, getattr(e, "message", str(e))
+
+
+class Mirror:
+    def __init__(self, url, directory, depth=MIRROR_DEPTH, scope="host", workers=DOWNLOAD_WORKERS,
+                 per_host=MIRROR_PER_HOST, delay=MIRROR_DELAY, progress=None):
+
+        self.root = _location(url)
+        if not self.root.walkable:
+            raise Error(f"not a menu: {url}")
+
+        self.root_url = format_url(self.root.host, self.root.port, "1", self.root.url)
+        self.directory = directory
+        self.state_path = os.path.join(directory, MIRROR_STATE_FILE)
+
+        self.depth = depth
+        self.scope = scope
+        self.workers = workers
+        self.per_host = per_host
+        self.delay = delay
+        self.progress = progress
+
+        self.seen = set()
+        self.pending = []
+        self.hosts = {}
+
+        self.saved = 0
+        self.failed = 0
+
+        self.state = None
+        self.queue = None
+
+    def _load(self):
+        # the state file is a journal of what was queued, saved and failed,
+        # so a crawl that was interrupted resumes with what was left
+        try:
+            with open(self.state_path, "rb") as file:
+                data = file.read()
+
+        except FileNotFoundError:
+            return False
+
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            # half a line from an interrupted write, which the next entry would run into
+            os.truncate(self.state_path, end)
+
+        entries = []
+        for number, line in enumerate(data[:end].splitlines(), 1):
+            try:
+                entry = json.loads(line)
+
+            except ValueError:
+                entry = None
+
+            if not isinstance(entry, list) or not entry:
+                log.warning("mirror: %s line %d is not a journal entry, skipped", self.state_path, number)
+                continue
+
+            entries.append(entry)
+
+        if not entries or entries[0] != ["mirror", self.root_url]:
+            raise Error(f"{self.directory} is the mirror of another url")
+
+        queued = {}
+        done = set()
+        for entry in entries[1:]:
+            if entry[0] == "queued" and len(entry) == 6:
+                queued[self._path(*entry[1:5])] = tuple(entry[1:])
+
+            elif entry[0] == "done":
+                done.add(entry[1])
+
+        self.seen.update(queued)
+        self.pending = [entry for entry in queued.values() if format_url(*entry[:4]) not in done]
+
+        log.info("mirror: resuming %s, %d of %d left", self.root_url, len(self.pending), len(queued))
+        return True
+
+    def _write(self, *entry):
+        self.state.write(f"{json.dumps(entry, ensure_ascii=False)}\n")
+        self.state.flush()
+
+    def _in_scope(self, host, port, selector):
+        if self.scope == "any":
+            return True
+
+        if (host.lower(), port) != (self.root.host.lower(), self.root.port):
+            return False
+
+        prefix = self.root.url.rstrip("/")
+        return self.scope == "host" or selector == prefix or selector.startswith(f"{prefix}/")
+
+    def _queue(self, host, port, char, selector, depth):
+        # links that differ only in the case of the host or in slashes are the same
+        # file on disk, so they are fetched once
+        file_path = self._path(host, port, char, selector)
+        if file_path in self.seen:
+            return
+
+        self.seen.add(file_path)
+        self._write("queued", host, port, char, selector, depth)
+        self.queue.put_nowait((host, port, char, selector, depth))
+
+    def _path(self, host, port, char, selector):
+        parts = [part for part in selector.replace("\\", "/").split("/") if part not in ["", ".", ".."]]
+        host = host.lower().replace(os.sep, "_")
+
+        path = os.path.join(self.directory, host if port == 70 else f"{host}_{port}", char, *parts)
+        if char == "1":
+            return os.path.join(path, MIRROR_MENU_FILE)
+
+        return path if parts else os.path.join(path, "index")
+
+    def _links(self, file_path, depth):
+        parser = MenuParser()
+        with open(file_path, "rb") as file:
+            rows = parser.feed(file.read()) + parser.close()
+
+        for row in rows:
+            if len(row) < 4 or not row[0] or not row[2]:
+                continue
+
+            char, selector, host = row[0][0], row[1], row[2]
+            type = TYPE_MAP.get(char)
+            if type is None or type in UNMIRRORED or selector.startswith("URL:"):
+                continue
+
+            if type == "dir" and depth >= self.depth:
+                continue
+
+            try:
+                port = int(row[3])
+
+            except ValueError:
+                continue
+
+            if 0 < port < 65536 and self._in_scope(host, port, selector):
+                self._queue(host, port, char, selector, depth + 1)
+
+    @contextlib.asynccontextmanager
+    async def _polite(self, host, port):
+        key = (host.lower(), port)
+        if key not in self.hosts:
+            self.hosts[key] = [asyncio.Semaphore(self.per_host), 0.0]
+
+        limit = self.hosts[key]
+        async with limit[0]:
+            # requests to a host start at least `delay` seconds apart
+            now = time.monotonic()
+            start = max(now, limit[1])
+            limit[1] = start + self.delay
+
+            await asyncio.sleep(start - now)
+            yield
+
+    async def _fetch(self, host, port, char, selector, depth):
+        url = format_url(host, port, char, selector)
+        file_path = self._path(host, port, char, selector)
+
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+            async with self._polite(host, port):
+                await get_file(Location(host, port, selector, walkable=char == "1"), file_path)
+
+            if char == "1":
+                self._links(file_path, depth)
+
+        except (Error, OSError) as e:
+            error = getattr(e, "message", str(e))
+            log.warning("mirror: %s failed: %s", url, error)
+
+        except Exception as e:
+            # a bug, but it must not end the worker: the queue would never be done
+            log.exception("mirror: %s failed", url)
+            error = f"error: {e!r}"
+
+        else:
+            self.saved += 1
+            self._write("done", url)
+            if self.progress:
+                self.progress(url, file_path, None)
+
+            return
+
+        self.failed += 1
+        self._write("failed", url, error)
+        if self.progress:
+            self.progress(url, None, error)
+
+    async def _worker(self):
+        while True:
+            entry = await self.queue.get()
+            try:
+                await self._fetch(*entry)
+
+            finally:
+                self.queue.task_done()
+
+    async def _run(self):
+        self.queue = asyncio.Queue()
+        for entry in self.pending:
+            self.queue.put_nowait(entry)
+
+        if not self.seen:
+            self._queue(self.root.host, self.root.port, "1", self.root.url, 0)
+
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        try:
+            await self.queue.join()
+
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        resumed = self._load()
+
+        with open(self.state_path, "a", encoding="utf-8") as self.state:
+            if not resumed:
+                self._write("mirror", self.root_url)
+
+            asyncio.run(self._run())
+
+        log.info("mirror: %s, %d saved, %d failed", self.root_url, self.saved, self.failed)
+        return self.saved, self.failed
+
+
+def dump(location, format="tsv", output=sys.stdout):
+    if not location.walkable:
+        output.write(fetch_text(location))
+        output.write("\n")
+        return
+
+    menu = fetch_menu(location)
+    for index in range(len(menu)):
+        entry = {
+            "type": menu.type(index),
+            "text": menu.texts[index],
+            "host": menu.hosts[index],
+            "port": menu.ports[index],
+            "selector": menu.urls[index],
+            "url": link(menu, index),
+        }
+
+        if format == "json":
+            output.write(f"{json.dumps(entry, ensure_ascii=False)}\n")
+
+        else:
+            output.write("\t".join(str(value).replace("\t", " ") for value in entry.values()))
+            output.write("\n")
+
+
+HEADLESS_OPTIONS = ["--dump", "--download", "--mirror"]
+
+
+def headless(arguments):
+    return any(argument.split("=")[0] in HEADLESS_OPTIONS for argument in arguments)
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        prog="pherguson", description="fetch gopher menus and files without the terminal ui")
+    commands = parser.add_mutually_exclusive_group(required=True)
+    commands.add_argument(
+        "--dump", metavar="URL",
+        help="print a menu (one line per entry) or a text file")
+    commands.add_argument(
+        "--download", metavar="URL", nargs="+",
+        help="download files, gopher or http")
+    commands.add_argument(
+        "--mirror", metavar="URL",
+        help="save a menu and everything it links to, recursively, under --output. "
+             "an interrupted mirror resumes where it stopped when run again")
+    parser.add_argument(
+        "--format", choices=DUMP_FORMATS, default="tsv",
+        help="menu format: tab separated type, text, host, port, selector and url, "
+             "or one JSON object per line (default: tsv)")
+    parser.add_argument(
+        "--output", metavar="DIR", default=".",
+        help="directory the downloads and mirrors are written to (default: .)")
+    parser.add_argument(
+        "--workers", type=int, default=DOWNLOAD_WORKERS, metavar="N",
+        help=f"parallel downloads, for --download and --mirror (default: {DOWNLOAD_WORKERS})")
+    parser.add_argument(
+        "--depth", type=int, default=MIRROR_DEPTH, metavar="N",
+        help=f"menus deeper than this are not followed when mirroring (default: {MIRROR_DEPTH})")
+    parser.add_argument(
+        "--scope", choices=MIRROR_SCOPES, default="host",
+        help="what a mirror follows: links to the same host, only below the starting "
+             "selector, or any host (default: host)")
+    parser.add_argument(
+        "--per-host", type=int, default=MIRROR_PER_HOST, metavar="N",
+        help=f"parallel requests to the same host when mirroring (default: {MIRROR_PER_HOST})")
+    parser.add_argument(
+        "--delay", type=float, default=MIRROR_DELAY, metavar="SECONDS",
+        help=f"time between two requests to the same host when mirroring (default: {MIRROR_DELAY})")
+
+    return parser.parse_args(arguments)
+
+
+def _report(url, file_path, error):
+    if error is not None:
+        print(f"pherguson: {url}: {error}", file=sys.stderr)
+
+    else:
+        print(file_path, flush=True)
+
+
+def mirror(arguments):
+    try:
+        mirror = Mirror(
+            arguments.mirror, arguments.output, arguments.depth, arguments.scope,
+            arguments.workers, arguments.per_host, arguments.delay, progress=_report)
+
+        saved, failed = mirror.run()
+
+    except Error as e:
+        print(f"pherguson: {e.message}", file=sys.stderr)
+        return 1
+
+    except KeyboardInterrupt:
+        print("pherguson: interrupted, run the same command again to resume", file=sys.stderr)
+        return 1
+
+    print(f"pherguson: {saved} saved, {failed} failed", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def main(arguments=None):
+    arguments = parse_arguments(arguments)
+
+    if arguments.dump:
+        try:
+            dump(parse_url(arguments.dump), arguments.format)
+
+        except Error as e:
+            print(f"pherguson: {e.message}", file=sys.stderr)
+            return 1
+
+        return 0
+
+    if arguments.mirror:
+        return mirror(arguments)
+
+    failed = 0
+    for url, file_path, error in download_all(arguments.download, arguments.output, arguments.workers):
+        _report(url, file_path, error)
+        failed += error is not None
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
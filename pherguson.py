@@ -1,44 +1,98 @@
 #!/usr/bin/env python
 
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import hashlib
+import json
+import logging
+import logging.handlers
+import multiprocessing
 import ntpath
 import os
-import pathlib
-import platform
 import queue
-import requests
+import re
 import shutil
 import signal
-import socket
+import sqlite3
 import sys
 import subprocess
 import threading
 import time
+
+try:
+    import fcntl
+
+except ImportError:
+    # windows: the bookmarks file is still replaced atomically, but not locked
+    fcntl = None
+
+try:
+    import resource
+
+except ImportError:
+    # windows: thumbnail workers run without the address space cap
+    resource = None
+
+from gopherlib import (
+    BINARIES, DOWNLOAD_WORKERS, Error, Location, Menu, Timing, Transfer,
+    atomic_write, fetch_gopher, fetch_http, format_age, format_size, get_content, get_file,
+    headless, is_image, log, parse_url)
+
+# the headless commands run without the terminal ui and its dependencies
+if __name__ == "__main__" and headless(sys.argv[1:]):
+    import gopherlib
+    sys.exit(gopherlib.main())
+
 import urwid
 
 from urllib.parse import urlparse
 
 
-APPLICATION_HANDLER = "xdg-open" if platform.system() == "Linux" else "open"
+APPLICATION_HANDLER = "xdg-open" if sys.platform.startswith("linux") else "open"
 DEFAULT_ROW_HEIGHT = 15
 EXPERIMENTAL_MOUSE_NAVIGATION = False
 HOME_DIRECTORY = os.path.expanduser("~")
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(threadName)s: %(message)s"
+LOG_LEVELS = ["debug", "info", "warning", "error"]
+METRICS_WINDOW = 100
+HISTORY_PAGE_SIZE = 200
+DOWNLOAD_PER_HOST = 2
+CACHE_QUOTA = 1024 * 1024 * 1024
+# seconds a query waits for another connection's write before "database is locked"
+SQLITE_TIMEOUT = 30
+
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_WORKER_MEMORY = 512 * 1024 * 1024
+THUMBNAIL_QUEUE_DELAY = 0.2
+
+MENU_CACHE_ENTRIES = 128
+MENU_CACHE_BYTES = 64 * 1024 * 1024
+MENU_CACHE_TTL = 15 * 60
+
+SEARCH_RESULTS = 100
+SEARCH_RANKED = 1000
+SEARCH_TITLE_LENGTH = 80
+SEARCH_EXCERPT_WORDS = 12
+SEARCH_SNIPPET_LENGTH = 16384
+SEARCH_COMPACT_DELAY = 30
+
+WIDGET_CACHE_SIZE = 512
+
+PREFETCH_DELAY = 0.3
+PREFETCH_BUDGET = 8 * 1024 * 1024
+PREFETCH_TYPES = ["dir", "txt"]
 THUMBNAIL_SIZE = (384, 256)
 USE_BOLD_FONT = True
 
-SOUND_PREVIEW_ENABLED = True if shutil.which("mpv") else False
 sound_preview_thread = None
 sound_preview_state = "STOPPED"
 sound_preview_filename = None
 
-INLINE_IMAGES_ENABLED = True if shutil.which("ueberzug") else False
-stop_image_preview_thread = False
-
-if INLINE_IMAGES_ENABLED:
-    from PIL import Image
-    import ueberzug.lib.v0 as ueberzug
-
 
 COLOR_MAP = [
     # gopher types
@@ -75,37 +129,6 @@ COLOR_MAP = [
     ("error", f"dark red{',bold' if USE_BOLD_FONT else ''}", urwid.DEFAULT),
 ]
 
-TYPE_MAP = {
-    # canonical types
-    "0": "txt",  # text file
-    "1": "dir",  # submenu
-    "2": "cns",  # CCSO Nameserver
-    "3": "err",  # Error
-    "4": "hex",  # Error
-    "5": "dos",  # DOS file
-    "6": "utf",  # uuencoded file
-    "7": "ask",  # full text search
-    "8": "tnt",  # telnet
-    "9": "bin",  # binary file
-    "+": "mir",  # mirror
-    "g": "gif",  # gif file
-    "I": "img",  # image file
-    "T": "tn3",  # telnet 3270
-    # non-canonical types
-    "d": "doc",  # pdf / .doc
-    "h": "htm",  # html file / link
-    "i": "inf",  # info message
-    "p": "png",  # image file
-    "r": "rtf",  # rft file
-    "s": "snd",  # sound file
-    ";": "vid",  # video file
-    "P": "pdf",  # pdf file
-    "X": "xml",  # xml file
-}
-SELECTABLES = ["txt", "dir", "gif", "htm", "img", "gif", "ask",
-               "bin", "png", "rtf", "snd", "vid", "pdf", "xml", "hex"]
-BINARIES = ["txt", "hex", "img", "gif", "bin", "png", "rtf", "pdf", "xml"]
-
 LANDING_PAGE = [
     ["iPHERGUSON"],
     ["i"],
@@ -130,10 +153,94 @@ LANDING_PAGE = [
 ]
 
 
+# looked up when first needed rather than when the module is imported
+@functools.lru_cache(maxsize=None)
+def sound_preview_enabled():
+    return shutil.which("mpv") is not None
+
+
+@functools.lru_cache(maxsize=None)
+def inline_images_enabled():
+    return shutil.which("ueberzug") is not None
+
+
 def shorten(path):
     return path.replace(HOME_DIRECTORY, "~")
 
 
+def file_digest(file_path):
+    digest = hashlib.sha256()
+
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def make_thumbnail(source, destination, size=THUMBNAIL_SIZE):
+    # PIL is slow to import and only needed once an image is shown
+    from PIL import Image
+
+    try:
+        with Image.open(source) as img:
+            # let the jpeg decoder scale down while decoding, no-op for other formats
+            img.draft("RGB", size)
+            img.thumbnail(size, reducing_gap=2.0)
+
+            if img.mode not in ["1", "L", "LA", "P", "RGB", "RGBA"]:
+                img = img.convert("RGB")
+
+            with atomic_write(destination) as file:
+                img.save(file, format="PNG")
+
+            return img.size
+
+    except Image.DecompressionBombError as e:
+        raise ValueError(str(e))
+
+
+thumbnail_worker_cache = None
+
+
+def init_thumbnail_worker(cache_directory, quota, memory_limit):
+    global thumbnail_worker_cache
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if memory_limit and resource is not None:
+        # the limit is headroom on top of what the worker maps once started
+        try:
+            with open("/proc/self/statm") as file:
+                memory_limit += int(file.read().split()[0]) * resource.getpagesize()
+
+        except OSError:
+            pass
+
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    thumbnail_worker_cache = Cache(cache_directory, quota)
+
+
+def generate_thumbnail(key, url, file_path, location=None):
+    cache = thumbnail_worker_cache
+
+    cached_path, _ = cache.lookup(key)
+    if cached_path is None:
+        transfer = Transfer(url)
+
+        if location is not None:
+            fetch_gopher(location, file_path, transfer)
+
+        else:
+            fetch_http(url, file_path, transfer)
+
+        cache.add(key, file_path, url, transfer.received)
+        cached_path = file_path
+
+    return cached_path, cache.store_thumbnail(cached_path)
+
+
 def execute(command):
     try:
         with open(os.devnull, "wb") as devnull:
@@ -143,67 +250,1248 @@ def execute(command):
         pass
 
 
+metrics_log = logging.getLogger("pherguson.metrics")
+metrics_log.addHandler(logging.NullHandler())
+metrics_log.propagate = False
+
+log_writers = {}
+
+
+class LogFile(logging.FileHandler):
+    def emit(self, record):
+        # the writer flushes once its queue is drained
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+
+            self.stream.write(f"{self.format(record)}{self.terminator}")
+
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(logging.handlers.QueueListener):
+    def handle(self, record):
+        super(LogWriter, self).handle(record)
+
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+def start_logging(file_path, level="info", logger=log, format=LOG_FORMAT):
+    handler = LogFile(file_path, delay=True)
+    handler.setFormatter(logging.Formatter(format))
+
+    records = queue.SimpleQueue()
+    log_writers[logger.name] = LogWriter(records, handler)
+    log_writers[logger.name].start()
+
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level.upper())
+
+
+def stop_logging():
+    for writer in log_writers.values():
+        writer.stop()
+        for handler in writer.handlers:
+            handler.close()
+
+    log_writers.clear()
+
+
 class Cache:
     cache_directory = f"{HOME_DIRECTORY}/.cache/pherguson"
 
-    @classmethod
-    def get_cache_directory(cls, host):
-        hash = hashlib.md5(host.encode()).hexdigest()[:8]
+    def __init__(self, cache_directory=None, quota=CACHE_QUOTA):
+        self.cache_directory = cache_directory or self.cache_directory
+        self.quota = quota
 
-        cache_directory = f"{cls.cache_directory}/{hash}"
-        path = pathlib.Path(cache_directory)
-        path.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
 
-        return cache_directory
+        os.makedirs(f"{self.cache_directory}/objects", exist_ok=True)
 
-    @classmethod
-    def file_exists(cls, file_path):
-        return pathlib.Path(file_path).is_file()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            f"{self.cache_directory}/index.sqlite3", timeout=SQLITE_TIMEOUT, check_same_thread=False)
 
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, path TEXT, url TEXT, size INTEGER, "
+                "fetched_at REAL, last_access REAL)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
 
-class Line:
-    def __init__(self, type, text, location):
-        self.type = type
-        self.text = text
-        self.location = location
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(entries)")]
+            for column in ["width", "height"]:
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE entries ADD COLUMN {column} INTEGER")
+
+            self.size = self._total()
+
+    def __str__(self):
+        return (
+            f"cache: {self.hits} hits, {self.misses} misses, "
+            f"{format_size(self.size)} / {format_size(self.quota)}"
+        )
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256("\t".join(str(part) for part in parts).encode()).hexdigest()
+
+    def path(self, key, url=""):
+        extension = os.path.splitext(url.rsplit("/")[-1])[1]
+        if not extension[1:].isalnum() or len(extension) > 8:
+            extension = ""
+
+        return f"{self.cache_directory}/objects/{key[:2]}/{key}{extension}"
+
+    def lookup(self, key):
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT path, fetched_at FROM entries WHERE key = ?", (key,)).fetchone()
+
+            if not self._exists(key, row):
+                self.misses += 1
+                return None, None
+
+            self.hits += 1
+            self.connection.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+
+        return row
+
+    def _exists(self, key, row):
+        if row is None:
+            return False
+
+        if not os.path.isfile(row[0]):
+            # deleted from the cache directory by hand: fetched again
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return False
+
+        return True
+
+    def _total(self):
+        # the thumbnail workers and other instances write to the same index,
+        # so the total is read back rather than kept count of
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def add(self, key, path, url, size, width=None, height=None):
+        now = time.time()
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries "
+                "(key, path, url, size, fetched_at, last_access, width, height) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, path, url, size, now, now, width, height))
+
+            self.size = self._total()
+
+        if self.size > self.quota:
+            self.evict()
+
+    def lookup_thumbnail(self, key):
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT path, width, height FROM entries WHERE key = ?", (key,)).fetchone()
+
+            if not self._exists(key, row):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+
+        return row
+
+    def store_thumbnail(self, source):
+        key = self.key("thumbnail", file_digest(source), *THUMBNAIL_SIZE)
 
-    def __repr__(self):
-        return f"{self.type}\t{self.text}\t{self.location}\n"
+        thumbnail = self.lookup_thumbnail(key)
+        if thumbnail is not None:
+            return thumbnail
 
+        path = self.prepare(self.path(key, "thumbnail.png"))
+        width, height = make_thumbnail(source, path)
+        self.add(key, path, source, os.path.getsize(path), width, height)
 
-class Location:
-    def __init__(self, host, port, url, focus=0, walkable=True,
-                 bookmarks=False, history=False):
+        return path, width, height
+
+    def remove(self, key):
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT path, size FROM entries WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                return
+
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.size -= row[1]
+
+        with contextlib.suppress(OSError):
+            os.remove(row[0])
+
+    def evict(self):
+        with self.lock, self.connection:
+            # taken before reading the total, so no other process evicts from it meanwhile
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.size = self._total()
+
+            rows = self.connection.execute(
+                "SELECT key, path, size FROM entries ORDER BY last_access")
+
+            evicted = []
+            for key, path, size in rows:
+                if self.size <= self.quota:
+                    break
+
+                evicted.append((key, path))
+                self.size -= size
+
+            self.connection.executemany(
+                "DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+
+        for _, path in evicted:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    def prepare(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def entry(self, location=None, url=None):
+        if location is not None:
+            key = self.key("gopher", location.host, location.port, location.url)
+            return key, self.path(key, location.url)
+
+        key = self.key("http", url)
+        return key, self.path(key, urlparse(url).path)
+
+    @staticmethod
+    def menu_key(location):
+        return Cache.key("menu", location.host, location.port, location.url, location.walkable)
+
+    def store_menu(self, location, rows):
+        key = self.menu_key(location)
+        path = self.prepare(self.path(key))
+        content = "\n".join("\t".join(row) for row in rows).encode("utf-8")
+
+        try:
+            with atomic_write(path) as file:
+                file.write(content)
+
+            self.add(key, path, str(location), len(content))
+
+        except (OSError, sqlite3.Error):
+            pass
+
+    def load_menu(self, location):
+        key = self.menu_key(location)
+        path, fetched_at = self.lookup(key)
+        if path is None:
+            return None, None
+
+        try:
+            with open(path, encoding="utf-8", newline="") as file:
+                content = file.read()
+
+        except (OSError, ValueError):
+            self.remove(key)
+            return None, None
+
+        rows = [row.split("\t") for row in content.split("\n")] if content else []
+        return rows, fetched_at
+
+
+class MenuCache:
+    def __init__(self, max_entries=MENU_CACHE_ENTRIES, max_bytes=MENU_CACHE_BYTES,
+                 ttl=MENU_CACHE_TTL):
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    @staticmethod
+    def key(location):
+        return (location.host, location.port, location.url, location.walkable)
+
+    def get(self, location):
+        key = self.key(location)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        lines, size, fetched_at = entry
+        if time.monotonic() - fetched_at > self.ttl:
+            self.remove(location)
+            return None
+
+        self.entries.move_to_end(key)
+        return lines
+
+    def put(self, location, lines):
+        size = lines.size()
+        if size > self.max_bytes:
+            return
+
+        self.remove(location)
+
+        self.entries[self.key(location)] = (lines, size, time.monotonic())
+        self.size += size
+
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def fresh(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and time.monotonic() - entry[2] <= self.ttl
+
+    def remove(self, location):
+        entry = self.entries.pop(self.key(location), None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+class Prefetcher:
+    # one prefetch at a time (the previous one is cancelled when the cursor moves),
+    # so there is never more than one connection per host either
+    def __init__(self, gopher, delay=PREFETCH_DELAY, budget=PREFETCH_BUDGET):
+        self.gopher = gopher
+        self.delay = delay
+        self.budget = budget
+
+        self.prefetched = {}
+
+        self.handle = None
+        self.task = None
+
+    def schedule(self, line):
+        self.cancel()
+
+        if line.type not in PREFETCH_TYPES or self.gopher.offline:
+            return
+
+        location = Location(
+            line.location.host, line.location.port, line.location.url,
+            walkable=line.type not in BINARIES)
+
+        if self.gopher.menu_cache.get(location) is not None:
+            return
+
+        self.handle = self.gopher.loop.call_later(self.delay, self._start, location)
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def claim(self, location):
+        prefetched = self.prefetched.pop(MenuCache.key(location), None)
+        if prefetched is not None:
+            # opened: stored and indexed like any page that was fetched
+            self.gopher._store_menu(location, prefetched[1])
+
+    def available(self):
+        # only what is still in the memory cache counts against the budget,
+        # prefetched pages that expired or were evicted give their share back
+        for key in list(self.prefetched):
+            if not self.gopher.menu_cache.fresh(key):
+                del self.prefetched[key]
+
+        return self.budget - sum(size for size, _ in self.prefetched.values())
+
+    def _start(self, location):
+        self.handle = None
+        self.task = self.gopher.loop.create_task(self._prefetch(location))
+
+    async def _prefetch(self, location):
+        available = self.available()
+        rows = []
+        size = 0
+
+        try:
+            async for content in get_content(location):
+                rows.extend(content)
+                size += sum(len(part) + 1 for row in content for part in row)
+
+                if size > available:
+                    return
+
+        except Error:
+            return
+
+        self.prefetched[MenuCache.key(location)] = (size, rows)
+        self.gopher.menu_cache.put(location, Menu(rows, location.walkable))
+
+
+class Metrics:
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.hosts = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.last = None
+
+    def percentiles(self, host):
+        samples = sorted(self.hosts[host])
+        if not samples:
+            return {}
+
+        return {
+            percentile: samples[min(len(samples) * percentile // 100, len(samples) - 1)]
+            for percentile in self.PERCENTILES
+        }
+
+    def record(self, timing):
+        timing.finish()
+
+        self.hosts[timing.host].append(timing.total)
+        self.last = timing
+
+        if metrics_log.isEnabledFor(logging.INFO):
+            record = timing.as_dict()
+            for percentile, total in self.percentiles(timing.host).items():
+                record[f"host_p{percentile}_ms"] = round(total * 1000, 1)
+
+            metrics_log.info(json.dumps(record))
+
+    def describe(self, timing):
+        percentiles = " / ".join(
+            f"p{percentile} {total * 1000:.0f}"
+            for percentile, total in self.percentiles(timing.host).items())
+
+        return f"{timing.name} {timing} | {timing.host} {percentiles} ms"
+
+
+class ThumbnailGenerator:
+    def __init__(self, gopher, workers=THUMBNAIL_WORKERS, memory_limit=THUMBNAIL_WORKER_MEMORY):
+        self.gopher = gopher
+        self.workers = workers
+        self.memory_limit = memory_limit
+
+        self.executor = None
+        self.futures = {}
+        self.handle = None
+
+    def _get_executor(self):
+        if self.executor is None:
+            # by now the process runs threads (history, search index, logging and
+            # executors) and a forked worker could inherit one of their locks held,
+            # so the workers start from a fresh process
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+            cache = self.gopher.cache
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context,
+                initializer=init_thumbnail_worker,
+                initargs=(cache.cache_directory, cache.quota, self.memory_limit))
+
+        return self.executor
+
+    def schedule(self):
+        if self.handle is not None:
+            self.handle.cancel()
+
+        self.handle = self.gopher.loop.call_later(THUMBNAIL_QUEUE_DELAY, self.queue)
+
+    def queue(self):
+        self.handle = None
+
+        if self.gopher.offline:
+            return
+
+        first, last = self.gopher.content_window.visible_range(pages=2)
+        for line in self.gopher.current_location_map[first:last]:
+            url = line.location.url.replace("URL:", "")
+
+            if line.type in ["img", "gif", "png"]:
+                location = line.location
+                key, file_path = self.gopher.cache.entry(location=location)
+                url = f"gopher://{location.host}:{location.port}{location.url}"
 
+            elif line.type == "htm" and url.startswith("http") and is_image(url):
+                location = None
+                key, file_path = self.gopher.cache.entry(url=url)
+
+            else:
+                continue
+
+            if key in self.futures or file_path in self.gopher.thumbnails:
+                continue
+
+            self.gopher.cache.prepare(file_path)
+            try:
+                future = self._get_executor().submit(
+                    generate_thumbnail, key, url, file_path, location)
+
+            except concurrent.futures.BrokenExecutor as e:
+                # a worker died (killed, crashed or failed to start): the next
+                # call starts new ones
+                log.error("thumbnail workers stopped: %r", e)
+                self.gopher.status_bar.set_status("thumbnails: a worker stopped, restarting them", level="error")
+
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+                self.futures = {}
+                return
+
+            self.futures[key] = future
+            future.add_done_callback(
+                lambda future, key=key, url=url: self.gopher.loop.call_soon_threadsafe(
+                    self._done, key, url, future))
+
+    def _done(self, key, url, future):
+        if self.futures.get(key) is future:
+            del self.futures[key]
+
+        if future.cancelled():
+            return
+
+        if future.exception() is not None:
+            log.warning("thumbnail %s failed: %r", url, future.exception())
+            return
+
+        file_path, thumbnail = future.result()
+        self.gopher.thumbnails[file_path] = thumbnail
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        for future in self.futures.values():
+            future.cancel()
+
+        self.futures = {}
+
+    def shutdown(self):
+        self.cancel()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class DownloadJob:
+    QUEUED = "queued"
+    ACTIVE = "active"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, name, host, file_path, run, background=False):
+        self.name = name
         self.host = host
-        self.port = int(port) if port else 70
-        self.url = url
+        self.file_path = file_path
+        self.run = run
+        self.background = background
 
-        self.focus = focus
-        self.walkable = walkable
+        self.state = self.QUEUED
+        self.transfer = Transfer(name)
+        self.error = None
+        self.task = None
+        self.callbacks = []
 
-        self.bookmarks = bookmarks
-        self.history = history
+    @property
+    def pending(self):
+        return self.state in [self.QUEUED, self.ACTIVE]
 
-    def __repr__(self):
-        return f"gopher://{self.host}:{self.port}{self.url}"
+    def __str__(self):
+        if self.state == self.ACTIVE:
+            return str(self.transfer)
 
-    def get_link(self, name=None):
-        url = "/" if self.url == "" else self.url
-        return (
-            f"{'1' if self.walkable else '0'}"
-            f"{name if name else url}\t{url}\t{self.host}\t{self.port}"
-        )
+        if self.state == self.DONE:
+            return (
+                f"done: {shorten(self.file_path)} {format_size(self.transfer.received)}, "
+                f"{format_size(self.transfer.rate)}/s"
+            )
 
+        if self.state == self.FAILED:
+            return f"failed: {self.name} ({self.error})"
 
-class Error(Exception):
-    def __init__(self, message):
-        self.message = message
+        return f"{self.state}: {self.name}"
 
 
-class History:
+class DownloadManager:
+    def __init__(self, loop, on_change=None, workers=DOWNLOAD_WORKERS,
+                 per_host=DOWNLOAD_PER_HOST):
+
+        self.loop = loop
+        self.on_change = on_change
+        self.workers = workers
+        self.per_host = per_host
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="download")
+        self.jobs = []
+
+    @property
+    def active(self):
+        return [job for job in self.jobs if job.state == DownloadJob.ACTIVE]
+
+    def find(self, file_path):
+        for job in self.jobs:
+            if job.pending and job.file_path == file_path:
+                return job
+
+    def submit(self, job, callback=None):
+        existing = self.find(job.file_path)
+        if existing:
+            existing.background = existing.background and job.background
+            job = existing
+
+        else:
+            self.jobs.append(job)
+
+        if callback:
+            job.callbacks.append(callback)
+
+        self._schedule()
+        self.changed(job)
+
+        return job
+
+    def cancel(self, job):
+        if job.state == DownloadJob.QUEUED:
+            job.state = DownloadJob.CANCELLED
+            self.changed(job)
+
+        elif job.state == DownloadJob.ACTIVE:
+            job.task.cancel()
+
+    def retry(self, job):
+        if job.state not in [DownloadJob.FAILED, DownloadJob.CANCELLED]:
+            return
+
+        job.state = DownloadJob.QUEUED
+        job.transfer = Transfer(job.name)
+        job.error = None
+
+        self._schedule()
+        self.changed(job)
+
+    def clear(self):
+        self.jobs = [job for job in self.jobs if job.pending]
+
+    def shutdown(self):
+        for job in self.jobs:
+            self.cancel(job)
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def changed(self, job):
+        if self.on_change:
+            self.on_change(job)
+
+    def _schedule(self):
+        active = self.active
+        hosts = collections.Counter(job.host for job in active)
+
+        for job in self.jobs:
+            if len(active) >= self.workers:
+                break
+
+            if job.state != DownloadJob.QUEUED or hosts[job.host] >= self.per_host:
+                continue
+
+            job.state = DownloadJob.ACTIVE
+            job.task = self.loop.create_task(self._run(job))
+            job.task.add_done_callback(lambda task, job=job: self._ended(job, task))
+            log.info("download started: %s", job.name)
+
+            active.append(job)
+            hosts[job.host] += 1
+
+    async def _run(self, job):
+        try:
+            await job.run(job)
+            job.state = DownloadJob.DONE
+
+        except asyncio.CancelledError:
+            job.state = DownloadJob.CANCELLED
+
+        except Error as e:
+            job.state = DownloadJob.FAILED
+            job.error = e.message
+
+        except (OSError, sqlite3.Error) as e:
+            job.state = DownloadJob.FAILED
+            job.error = str(e)
+
+        except Exception as e:
+            # a failing job must not take the main loop down with it
+            log.exception("download %s failed", job.name)
+            job.state = DownloadJob.FAILED
+            job.error = f"error: {e!r}"
+
+        job.transfer.finish()
+        log.log(logging.WARNING if job.state == DownloadJob.FAILED else logging.INFO, "download %s", job)
+
+        if job.state == DownloadJob.DONE:
+            for callback in job.callbacks:
+                self.loop.call_soon(callback, job.file_path)
+
+        job.callbacks = []
+
+        self._schedule()
+        self.changed(job)
+
+    def _ended(self, job, task):
+        # a task cancelled before its first step never runs _run
+        if task.cancelled() and job.state == DownloadJob.ACTIVE:
+            job.state = DownloadJob.CANCELLED
+            job.callbacks = []
+
+            self._schedule()
+            self.changed(job)
+
+
+class ImageCanvas:
     def __init__(self):
+        self.commands = queue.Queue()
+        self.thread = None
+
+    def show(self, identifier, path, x, y, width=50):
+        self._send("show", identifier, path=path, x=x, y=y, width=width)
+
+    def hide(self, identifier):
+        if self.thread is not None:
+            self._send("hide", identifier)
+
+    def stop(self):
+        if self.thread is not None:
+            self.commands.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _send(self, action, identifier, **options):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="ueberzug")
+            self.thread.start()
+
+        self.commands.put((action, identifier, options))
+
+    def _run(self):
+        import ueberzug.lib.v0 as ueberzug
+
+        placements = {}
+
+        with ueberzug.Canvas() as canvas:
+            while True:
+                command = self.commands.get()
+                if command is None:
+                    break
+
+                action, identifier, options = command
+
+                with canvas.lazy_drawing:
+                    placement = placements.get(identifier)
+
+                    if action == "show" and placement is None:
+                        placements[identifier] = canvas.create_placement(
+                            identifier,
+                            scaler=ueberzug.ScalerOption.FIT_CONTAIN.value,
+                            visibility=ueberzug.Visibility.VISIBLE,
+                            **options)
+
+                    elif action == "show":
+                        for name, value in options.items():
+                            setattr(placement, name, value)
+
+                        placement.visibility = ueberzug.Visibility.VISIBLE
+
+                    elif action == "hide" and placement is not None:
+                        placement.visibility = ueberzug.Visibility.INVISIBLE
+
+
+class HistoryStore:
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS visits (
+            id INTEGER PRIMARY KEY,
+            visited_at REAL NOT NULL,
+            host TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            selector TEXT NOT NULL,
+            walkable INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS visits_host ON visits (host)",
+        "CREATE INDEX IF NOT EXISTS visits_selector ON visits (selector)",
+    ]
+    SEARCH_SCHEMA = [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS visits_search USING fts5(
+            host, selector, content='visits', content_rowid='id', tokenize='trigram'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS visits_search_insert AFTER INSERT ON visits BEGIN
+            INSERT INTO visits_search (rowid, host, selector)
+            VALUES (new.id, new.host, new.selector);
+        END""",
+    ]
+    COLUMNS = "id, visited_at, host, port, selector, walkable"
+
+    def __init__(self, directory=None):
+        self.directory = directory or f"{HOME_DIRECTORY}/.config/pherguson"
+        self.database = f"{self.directory}/history.sqlite3"
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._connection = None
+        self.searchable = True
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write, name="history", daemon=True)
+        self.thread.start()
+
+    @property
+    def connection(self):
+        # opened on the first read, the writer thread opens its own
+        if self._connection is None:
+            self._connection = self._connect()
+
+        return self._connection
+
+    def _connect(self):
+        connection = sqlite3.connect(self.database, timeout=SQLITE_TIMEOUT)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        with connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+            try:
+                for statement in self.SEARCH_SCHEMA:
+                    connection.execute(statement)
+
+            except sqlite3.OperationalError:
+                # sqlite built without fts5 or its trigram tokenizer
+                self.searchable = False
+
+        return connection
+
+    def add(self, location):
+        self.queue.put((time.time(), location.host, location.port, location.url, int(location.walkable)))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _write(self):
+        connection = self._connect()
+        self._import(connection)
+
+        running = True
+        while running:
+            visits = [self.queue.get()]
+
+            # everything queued while the last batch was written goes in one transaction
+            while not self.queue.empty():
+                visits.append(self.queue.get())
+
+            if None in visits:
+                visits.remove(None)
+                running = False
+
+            try:
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO visits (visited_at, host, port, selector, walkable) "
+                        "VALUES (?, ?, ?, ?, ?)", visits)
+
+            except sqlite3.Error as e:
+                log.warning("history: could not write %d visits: %r", len(visits), e)
+
+        connection.close()
+
+    def _import(self, connection):
+        legacy = f"{self.directory}/history"
+        if not os.path.exists(legacy) or connection.execute("SELECT 1 FROM visits LIMIT 1").fetchone():
+            return
+
+        visits = []
+        with open(legacy, errors="replace") as file:
+            for line in file:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 4 or not fields[0]:
+                    continue
+
+                try:
+                    visited_at = datetime.datetime.strptime(
+                        fields[0][1:20], "%Y-%m-%d %H:%M:%S").timestamp()
+                    port = int(fields[3])
+
+                except ValueError:
+                    continue
+
+                visits.append((visited_at, fields[2], port, fields[1], int(fields[0][0] == "1")))
+
+        with connection:
+            connection.executemany(
+                "INSERT INTO visits (visited_at, host, port, selector, walkable) "
+                "VALUES (?, ?, ?, ?, ?)", visits)
+
+        log.info("history: imported %d visits from %s", len(visits), legacy)
+
+    def page(self, query="", before=None, limit=HISTORY_PAGE_SIZE):
+        connection = self.connection
+        before = before if before is not None else sys.maxsize
+
+        if not query:
+            statement = f"SELECT {self.COLUMNS} FROM visits WHERE id < ? ORDER BY id DESC LIMIT ?"
+            parameters = (before, limit)
+
+        elif self.searchable and len(query) >= 3:
+            # trigrams match substrings of the host and selector from the index
+            statement = (
+                f"SELECT {self.COLUMNS} FROM visits WHERE id IN "
+                "(SELECT rowid FROM visits_search WHERE visits_search MATCH ?) "
+                "AND id < ? ORDER BY id DESC LIMIT ?")
+            parameters = ('"{}"'.format(query.replace('"', '""')), before, limit)
+
+        else:
+            end = f"{query}\U0010ffff"
+            statement = (
+                f"SELECT {self.COLUMNS} FROM visits "
+                "WHERE ((host >= ? AND host < ?) OR (selector >= ? AND selector < ?)) "
+                "AND id < ? ORDER BY id DESC LIMIT ?")
+            parameters = (query, end, query, end, before, limit)
+
+        try:
+            return connection.execute(statement, parameters).fetchall()
+
+        except sqlite3.Error as e:
+            log.warning("history: query %r failed: %r", query, e)
+            return []
+
+
+class SearchIndex:
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS pages (
+            id INTEGER PRIMARY KEY,
+            host TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            selector TEXT NOT NULL,
+            walkable INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            indexed_at REAL NOT NULL,
+            UNIQUE (host, port, selector, walkable)
+        )""",
+        """CREATE VIRTUAL TABLE IF NOT EXISTS pages_search USING fts5(
+            title, body, tokenize='unicode61 remove_diacritics 2'
+        )""",
+    ]
+
+    def __init__(self, directory=None, compact_delay=SEARCH_COMPACT_DELAY):
+        self.directory = directory or Cache.cache_directory
+        self.database = f"{self.directory}/search.sqlite3"
+        self.compact_delay = compact_delay
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.connection = self._connect()
+        self.available = True
+
+        try:
+            with self.connection:
+                for statement in self.SCHEMA:
+                    self.connection.execute(statement)
+
+        except sqlite3.OperationalError as e:
+            # sqlite built without fts5
+            log.warning("search: index unavailable: %r", e)
+            self.available = False
+            return
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write, name="search", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.database, timeout=SQLITE_TIMEOUT)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        return connection
+
+    def add(self, location, rows):
+        if self.available:
+            self.queue.put((location.host, location.port, location.url, int(location.walkable), rows))
+
+    def close(self):
+        if self.available:
+            self.queue.put(None)
+            self.thread.join()
+
+        self.connection.close()
+
+    def _write(self):
+        connection = self._connect()
+        written = 0
+
+        running = True
+        while running:
+            try:
+                pages = [self.queue.get(timeout=self.compact_delay if written else None)]
+
+            except queue.Empty:
+                self._compact(connection, written)
+                written = 0
+                continue
+
+            while not self.queue.empty():
+                pages.append(self.queue.get())
+
+            if None in pages:
+                pages.remove(None)
+                running = False
+
+            try:
+                with connection:
+                    for page in pages:
+                        self._index(connection, *page)
+
+                written += len(pages)
+
+            except sqlite3.Error as e:
+                log.warning("search: could not index %d pages: %r", len(pages), e)
+
+        connection.close()
+
+    def _index(self, connection, host, port, selector, walkable, rows):
+        if walkable:
+            texts = [row[0][1:] for row in rows if row and row[0]]
+
+        else:
+            texts = ["\t".join(row) for row in rows]
+
+        title = next((text.strip() for text in texts if text.strip()), selector)
+        title = title[:SEARCH_TITLE_LENGTH]
+
+        page = connection.execute(
+            "SELECT id FROM pages WHERE host = ? AND port = ? AND selector = ? AND walkable = ?",
+            (host, port, selector, walkable)).fetchone()
+
+        # a page indexed again gets a new id, so the newest pages have the highest ones
+        if page is not None:
+            connection.execute("DELETE FROM pages WHERE id = ?", page)
+            connection.execute("DELETE FROM pages_search WHERE rowid = ?", page)
+
+        page_id = connection.execute(
+            "INSERT INTO pages (host, port, selector, walkable, title, indexed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (host, port, selector, walkable, title, time.time())).lastrowid
+
+        connection.execute(
+            "INSERT INTO pages_search (rowid, title, body) VALUES (?, ?, ?)",
+            (page_id, title, "\n".join(texts)))
+
+    def _compact(self, connection, written):
+        # merges the index segments left by incremental writes into one
+        started = time.monotonic()
+
+        try:
+            with connection:
+                connection.execute("INSERT INTO pages_search (pages_search) VALUES ('optimize')")
+
+        except sqlite3.Error as e:
+            log.warning("search: could not compact the index: %r", e)
+            return
+
+        log.info(
+            "search: compacted the index after %d pages in %.0f ms",
+            written, (time.monotonic() - started) * 1000)
+
+    def search(self, query, limit=SEARCH_RESULTS):
+        words = query.split()
+        if not self.available or not words:
+            return []
+
+        # every word has to match
+        terms = " ".join('"{}"'.format(word.replace('"', '""')) for word in words)
+
+        try:
+            # ranking every page a common word appears in is slow, so only the most
+            # recently indexed matches are ranked
+            lowest = self.connection.execute(
+                "SELECT rowid FROM pages_search WHERE pages_search MATCH ? "
+                "ORDER BY rowid DESC LIMIT 1 OFFSET ?", (terms, SEARCH_RANKED - 1)).fetchone()
+
+            pages = self.connection.execute(
+                "SELECT pages.host, pages.port, pages.selector, pages.walkable, pages.title, "
+                "CASE WHEN length(pages_search.body) <= ? "
+                f"THEN snippet(pages_search, 1, '', '', '...', {SEARCH_EXCERPT_WORDS}) "
+                "ELSE pages_search.body END, length(pages_search.body) <= ? "
+                "FROM pages_search JOIN pages ON pages.id = pages_search.rowid "
+                "WHERE pages_search MATCH ? AND pages_search.rowid >= ? ORDER BY rank LIMIT ?",
+                (SEARCH_SNIPPET_LENGTH, SEARCH_SNIPPET_LENGTH,
+                 terms, lowest[0] if lowest else 0, limit)).fetchall()
+
+        except sqlite3.Error as e:
+            log.warning("search: query %r failed: %r", query, e)
+            return []
+
+        # fts5's snippet() gets quadratic on large pages (seconds for a 1 MB menu),
+        # so their excerpt is cut around the first match here instead
+        patterns = [
+            re.compile(r"\b" + r"\W+".join(re.escape(word) for word in words), re.IGNORECASE),
+            re.compile("|".join(r"\b" + re.escape(word) for word in words), re.IGNORECASE)]
+        return [
+            page[:6] if page[6] else page[:5] + (self._excerpt(page[5], patterns),)
+            for page in pages]
+
+    def _excerpt(self, body, patterns, length=SEARCH_EXCERPT_WORDS):
+        # the words next to each other if they are, any of them otherwise
+        match = next(filter(None, (pattern.search(body) for pattern in patterns)), None)
+        start = match.start() if match else 0
+        window = 20 * length
+
+        before = body[max(0, start - window):start].split()
+        after = body[start:start + window].split()
+
+        kept = before[-(length // 2):] if length > 1 else []
+        excerpt = " ".join(kept + after[:length - len(kept)])
+
+        if len(before) > len(kept) or start > window:
+            excerpt = f"...{excerpt}"
+        if len(after) > length - len(kept) or len(body) > start + window:
+            excerpt = f"{excerpt}..."
+
+        return excerpt
+
+
+class BookmarkStore:
+    def __init__(self, directory=None):
+        self.directory = directory or f"{HOME_DIRECTORY}/.config/pherguson"
+        self.path = f"{self.directory}/bookmarks"
+
+        self.menu = Menu()
+        self.keys = []
+        self.stamp = None
+
+        self.query = ""
+        self.matches = None
+
+    def _stamp(self, file=None):
+        try:
+            stat = os.stat(file if file is not None else self.path)
+
+        except FileNotFoundError:
+            return None
+
+        # a write from any instance replaces the file, so its inode changes too
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as file:
+                return file.read(), self._stamp(file.fileno())
+
+        except FileNotFoundError:
+            return b"", None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _index(self, data, stamp):
+        rows = []
+        self.keys = []
+        self.stamp = stamp
+
+        for line in data.decode(errors="replace").split("\n"):
+            if not line.strip():
+                continue
+
+            row = line.rstrip("\r").split("\t")
+            rows.append(row)
+            self.keys.append(" ".join([row[0][1:]] + row[2:3] + row[1:2]).lower())
+
+        self.menu = Menu(rows)
+
+        self.query, self.matches = "", None
+
+    @contextlib.contextmanager
+    def _lock(self):
+        with open(f"{self.path}.lock", "a") as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+
+            yield
+
+    def load(self):
+        if self._stamp() != self.stamp:
+            self._index(*self._read())
+
+    def add(self, location, name):
+        os.makedirs(self.directory, exist_ok=True)
+
+        with self._lock():
+            # another instance may have saved a bookmark since this one was loaded
+            data, _ = self._read()
+            if data and not data.endswith(b"\n"):
+                data += b"\n"
+
+            data += f"{location.get_link(name)}\n".encode()
+            with atomic_write(self.path) as file:
+                file.write(data)
+
+            self._index(data, self._stamp())
+
+    def filter(self, query):
+        query = "".join(query.lower().split())
+        if not query:
+            return range(len(self.keys))
+
+        # a longer query only ever matches a subset of what the shorter one did
+        candidates = range(len(self.keys))
+        if self.matches is not None and query.startswith(self.query):
+            candidates = self.matches
+
+        pattern = re.compile("".join(
+            f"{re.escape(char)}[^{re.escape(next_char)}]*"
+            for char, next_char in zip(query, query[1:])) + re.escape(query[-1]))
+
+        matches = []
+        scores = []
+        keys = self.keys
+        for index in candidates:
+            match = pattern.search(keys[index])
+            if match:
+                matches.append(index)
+                scores.append((match.end() - match.start(), match.start(), index))
+
+        self.query, self.matches = query, matches
+
+        scores.sort()
+        return [index for _, _, index in scores]
+
+
+class History:
+    def __init__(self, directory=None):
+        self.directory = directory
         self.history = []
+        self._store = None
+        self.bookmarks = BookmarkStore(directory)
+
+    @property
+    def store(self):
+        # opened on the first visit rather than when the module is imported
+        if self._store is None:
+            self._store = HistoryStore(self.directory)
+
+        return self._store
 
     @property
     def current_location(self):
@@ -212,13 +1500,8 @@ class History:
 
         return self.history[-1]
 
-    def forward(self, location):
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        link = location.get_link(name=f"{timestamp} {str(location)}")
-
-        with open(f"{HOME_DIRECTORY}/.config/pherguson/history", "a") as file:
-            file.write(f"{link}\n")
-
+    def forward(self, location):
+        self.store.add(location)
         self.history.append(location)
 
     def set_focus(self, focus):
@@ -228,50 +1511,124 @@ class History:
         if len(self.history) > 1:
             self.history.pop()
 
-    def show_bookmarks(self):
-        self.history.append(Location("", 70, "", bookmarks=True))
-
-    def show_history(self):
-        self.history.append(Location("", 70, "", history=True))
-
-
-try:
-    history = History()
-    if len(sys.argv) > 1:
-        url = sys.argv[1]
-
-        if not url.startswith("gopher://"):
-            url = f"gopher://{url}"
-
-        url = urlparse(url)
-        host, port = url.netloc.split(":") if ":" in url.netloc else (url.netloc, 70)
-        history.forward(Location(host, port, url.path))
+    def discard(self, location):
+        if len(self.history) > 1 and location in self.history:
+            self.history.remove(location)
+
+    def show_bookmarks(self, query=""):
+        self.history.append(Location("", 70, query, bookmarks=True))
+
+    def show_history(self, query=""):
+        self.history.append(Location("", 70, query, history=True))
+
+    def show_search(self, query):
+        self.history.append(Location("", 70, query, search=True))
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        prog="pherguson",
+        epilog="without the terminal ui: pherguson --dump URL [--format tsv|json], "
+               "pherguson --download URL [URL ...] [--output DIR] "
+               "or pherguson --mirror URL [--output DIR] (see python gopherlib.py --help)")
+    parser.add_argument("url", nargs="?", help="gopher url to open")
+    parser.add_argument(
+        "--offline", action="store_true",
+        help="browse from the cache only, never touch the network")
+    parser.add_argument(
+        "--prefetch", action="store_true",
+        help="fetch the highlighted menu in the background")
+    parser.add_argument(
+        "--cache-quota", type=int, default=CACHE_QUOTA // (1024 * 1024), metavar="MB",
+        help="disk space used by the cache before old entries are evicted")
+    parser.add_argument(
+        "--thumbnails", action="store_true",
+        help="generate the thumbnails of the images on screen in the background")
+    parser.add_argument(
+        "--thumbnail-workers", type=int, default=THUMBNAIL_WORKERS, metavar="N",
+        help="number of processes generating thumbnails")
+    parser.add_argument(
+        "--thumbnail-memory", type=int, default=THUMBNAIL_WORKER_MEMORY // (1024 * 1024),
+        metavar="MB", help="memory limit of each thumbnail process")
+    parser.add_argument(
+        "--log", metavar="FILE",
+        help="write a log to FILE (off by default)")
+    parser.add_argument(
+        "--log-level", choices=LOG_LEVELS, default="info",
+        help="lowest level written to the log (default: info)")
+    parser.add_argument(
+        "--metrics", metavar="FILE",
+        help="append the timings of every fetch to FILE, one JSON object per line")
+
+    return parser.parse_args(arguments)
+
+
+history = History()
+
+
+class EventLoop(urwid.AsyncioEventLoop):
+    FRAME_INTERVAL = 1 / 30
+
+    def __init__(self, **kwargs):
+        super(EventLoop, self).__init__(**kwargs)
+
+        self.idle_callbacks = {}
+        self.idle_handle = None
+        self.last_idle = 0
+
+    # urwid emulates idle on asyncio by polling; instead, run the idle callbacks
+    # (which redraw the screen) once after each batch of events, or on request
+    def enter_idle(self, callback):
+        handle = object()
+        self.idle_callbacks[handle] = callback
+
+        return handle
+
+    def remove_enter_idle(self, handle):
+        return self.idle_callbacks.pop(handle, None) is not None
+
+    def alarm(self, seconds, callback):
+        def _callback():
+            callback()
+            self.request_idle(immediate=True)
+
+        return super(EventLoop, self).alarm(seconds, _callback)
+
+    def watch_file(self, fd, callback):
+        def _callback():
+            callback()
+            self.request_idle(immediate=True)
+
+        return super(EventLoop, self).watch_file(fd, _callback)
+
+    def request_idle(self, immediate=False):
+        if self.idle_handle is not None:
+            return
 
-    else:
-        history.forward(Location("gopher.flatline.ltd", 70, "/"))
+        if immediate:
+            self.idle_handle = self._loop.call_soon(self._run_idle)
 
-except Exception as e:
-    print(e)
-    time.sleep(3)
+        else:
+            delay = max(self.last_idle + self.FRAME_INTERVAL - time.monotonic(), 0)
+            self.idle_handle = self._loop.call_later(delay, self._run_idle)
 
+    def _run_idle(self):
+        self.idle_handle = None
+        self.last_idle = time.monotonic()
 
-class Highlight(urwid.AttrMap):
-    def __init__(self, attr_map):
-        urwid.AttrMap.__init__(
-            self,
-            urwid.Text(attr_map.base_widget.text),
-            "selection",
-        )
-        self.backup = attr_map
+        for callback in list(self.idle_callbacks.values()):
+            callback()
 
 
 class Selectable(urwid.WidgetWrap):
+    focus_map = "selection"
+
     def __init__(self, text, type, expandable=False, *args, **kwargs):
         self.text = text
         if expandable:
             self.text = f"+ {self.text}"
 
-        self.attr_map = urwid.AttrMap(urwid.Text(self.text), type)
+        self.attr_map = urwid.AttrMap(urwid.Text(self.text), type, self.focus_map)
         super(Selectable, self).__init__(self.attr_map)
 
     def selectable(self):
@@ -282,6 +1639,8 @@ class Selectable(urwid.WidgetWrap):
 
 
 class Unselectable(Selectable):
+    focus_map = None
+
     def selectable(self):
         return False
 
@@ -297,121 +1656,273 @@ class Box(urwid.Pile):
         return False
 
 
-def is_image(url):
-    for image_type in ["jpg", "jpeg", "png", "gif"]:
-        if image_type in url.lower():
-            return True
+class LineWalker(urwid.ListWalker):
+    def __init__(self):
+        self.lines = Menu()
+        self.focus = 0
+
+        self.preview = None
+        self.widgets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def set_lines(self, lines):
+        self.lines = lines
+        self.focus = 0
+
+        self.preview = None
+        self.widgets = collections.OrderedDict()
+
+        self._modified()
+
+    def extend(self, rows):
+        self.lines.extend(rows)
+        self._modified()
+
+    def selectable(self, position):
+        return self.lines.is_selectable(position)
+
+    def set_preview(self, position, pixels=None):
+        if self.preview:
+            self.widgets.pop(self.preview[0], None)
+
+        self.widgets.pop(position, None)
+
+        self.preview = (position, pixels) if position is not None else None
+        self._modified()
+
+    def get_focus(self):
+        if not self.lines:
+            return None, None
+
+        return self._widget(self.focus), self.focus
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        if position + 1 >= len(self.lines):
+            return None, None
+
+        return self._widget(position + 1), position + 1
+
+    def get_prev(self, position):
+        if position <= 0:
+            return None, None
+
+        return self._widget(position - 1), position - 1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self.lines) - 1, -1, -1)
+
+        return range(len(self.lines))
 
-    return False
+    def _widget(self, position):
+        widget = self.widgets.get(position)
+
+        if widget is not None:
+            self.widgets.move_to_end(position)
+            return widget
+
+        widget = self._build(position)
+
+        self.widgets[position] = widget
+        if len(self.widgets) > WIDGET_CACHE_SIZE:
+            self.widgets.popitem(last=False)
+
+        return widget
+
+    def _build(self, position):
+        lines = self.lines
+        type = lines.type(position)
+        previewed = self.preview is not None and self.preview[0] == position
+
+        if not lines.is_selectable(position):
+            widget = Unselectable(lines.text(position), type)
+
+        else:
+            expandable = lines.is_image(position) and inline_images_enabled()
+
+            text = f"{type.upper()} {lines.text(position)}"
+            if expandable and type == "htm":
+                type = "htm_img"
+
+            if previewed:
+                text = f"- {text}"
+
+            widget = Selectable(text, type, expandable=expandable and not previewed)
+
+        if previewed:
+            widget = urwid.Pile([widget, Box(self.preview[1])])
+
+        return widget
 
 
 class ContentWindow(urwid.ListBox):
     def __init__(self, gopher):
         self.gopher = gopher
-        self.walker = urwid.SimpleFocusListWalker([])
+        self.walker = LineWalker()
         super(ContentWindow, self).__init__(self.walker)
 
         self.image_preview = None
         self.current_highlight = None
+        self.pending_focus = None
+        self.last_size = None
+        self.image_preview_y = None
+        self.search_query = ""
 
     def clear(self):
-        for i in range(len(self.walker)):
-            self.walker.pop()
+        if self.image_preview:
+            self.close_image_preview()
+
+        self.walker.set_lines(Menu())
+
+        self.current_highlight = None
+        self.pending_focus = None
 
     def set_content(self, lines, focus):
-        def _is_expandable(url):
-            return INLINE_IMAGES_ENABLED and is_image(url.lower())
+        self.walker.set_lines(lines)
 
-        for line in lines:
-            selectable = line.type in SELECTABLES
-            expandable = _is_expandable(line.location.url)
+        self.pending_focus = focus or 0
+        self.append_content([])
 
-            type = line.type
+    def append_content(self, lines):
+        if lines:
+            self.walker.extend(lines)
 
-            if expandable and line.type == "htm":
-                type = "htm_img"
+        if self.pending_focus is not None:
+            self._apply_focus()
 
-            formatted_text = (
-                f"{line.type.upper() if selectable else ''}"
-                f"{' ' if selectable else ''}{line.text}"
-            )
-            self.walker.append(
-                Selectable(formatted_text, type, expandable=expandable)
-                if selectable else
-                Unselectable(formatted_text, type)
-            )
+        self.gopher.redraw()
 
-        if focus > len(self.walker):
-            focus = 0
+    def finish_content(self):
+        if self.pending_focus is not None and self.pending_focus >= len(self.walker):
+            self.pending_focus = 0
+            self._apply_focus()
 
-        if not history.current_location.walkable and len(self.walker) > 0:
-            self.set_focus(0)
+        self.pending_focus = None
 
-        else:
-            if len(self.walker) < 1:
-                return
+        if self.gopher.thumbnail_generator:
+            self.gopher.thumbnail_generator.schedule()
 
-            # find first selectable element
-            while (not self.walker[focus].base_widget.selectable() and focus < len(self.walker) - 1):
-                focus += 1
+    def visible_range(self, pages=1):
+        if self.last_size is None:
+            try:
+                height = os.get_terminal_size().lines
 
-            if focus == len(self.walker) - 1:
-                return
+            except OSError:
+                height = 24
 
-            self.set_highlight(focus)
-            self.set_focus(focus)
-            history.current_location.focus = focus
+            return 0, height * pages
 
-    def set_highlight(self, focus):
-        if self.current_highlight is not None:
-            try:
-                old = self.body[self.current_highlight]
-                self.body[self.current_highlight] = old.backup
+        focus = self.get_focus()[1]
+        _, top, _ = self.calculate_visible(self.last_size, True)
+        if top is None:
+            return 0, 0
 
-            except Exception:
-                pass
+        first = max(focus - len(top[1]), 0)
 
-        if focus is None:
-            self.current_highlight = None
-        else:
-            self.body[focus] = Highlight(self.body[focus])
-            self.current_highlight = focus
+        return first, first + self.last_size[1] * pages
 
-            line = self.gopher.current_location_map[focus]
-            if "URL" in line.location.url:
-                url = line.location.url.replace("URL:", "")
+    def render(self, size, focus=False):
+        self.last_size = size
 
-            else:
-                url = f"gopher://{line.location.host}{line.location.url}"
+        # the highlight is the focus attribute of the focused row, which has to show
+        # while the url bar or an overlay has the input focus too
+        started = time.monotonic()
+        canvas = super(ContentWindow, self).render(size, True)
+        self.gopher.rendered(time.monotonic() - started)
+
+        if self.image_preview:
+            self._place_image_preview(size)
+
+        return canvas
+
+    def _apply_focus(self):
+        focus = self.pending_focus
+
+        if not history.current_location.walkable:
+            if len(self.walker) > 0:
+                self.set_focus(0)
+                self.pending_focus = None
+
+            return
+
+        # wait for more lines when the focus target has not been streamed yet
+        if focus >= len(self.walker):
+            return
+
+        # find first selectable element
+        while not self.walker.selectable(focus) and focus < len(self.walker) - 1:
+            focus += 1
+
+        if not self.walker.selectable(focus):
+            return
+
+        self.pending_focus = None
+
+        self.set_highlight(focus)
+        self.set_focus(focus)
+        history.current_location.focus = focus
 
-            self.gopher.status_bar.set_status(url)
+    def set_highlight(self, focus):
+        self.current_highlight = focus
+
+        if focus is not None:
+            self.gopher.status_bar.set_status(self.gopher.current_location_map.status_url(focus))
+
+            if self.gopher.prefetcher:
+                self.gopher.prefetcher.schedule(self.gopher.current_location_map[focus])
 
     def scroll(self):
+        self.pending_focus = None
+
         new_focus = self.get_focus()[1]
         history.current_location.focus = new_focus
 
-        if self.walker[new_focus].base_widget.selectable():
+        if self.walker.selectable(new_focus):
             self.set_highlight(new_focus)
 
+        if history.current_location.history and new_focus >= len(self.walker) - HISTORY_PAGE_SIZE // 4:
+            self.gopher.more_history()
+
+        if self.gopher.thumbnail_generator:
+            self.gopher.thumbnail_generator.schedule()
+
+    def find(self, query, start, backward=False):
+        position = self.gopher.current_location_map.find(query, start, backward)
+        if position is None:
+            self.gopher.status_bar.set_status(f"/{query}: not found", level="warning")
+            return
+
+        self.set_focus(position)
+        self.scroll()
+
+        self.gopher.status_bar.set_status(
+            f"/{query}: line {position + 1} of {len(self.walker)} (n/N for next/previous)")
+
     def forward(self, line):
         try:
             walkable = line.type not in BINARIES
 
             history.current_location.focus = self.current_highlight
-            line.location.walkable = walkable
-            history.forward(line.location)
-            history.current_location.walkable = walkable
+            history.forward(Location(
+                line.location.host, line.location.port, line.location.url,
+                walkable=walkable))
 
             self.gopher.crawl()
 
         except Exception as e:
             self.gopher.status_bar.set_status(f"error: {e}")
 
-    def forward_htm(self, line, offset=0):
+    def forward_htm(self, line):
         url = line.location.url.replace("URL:", "")
 
-        if INLINE_IMAGES_ENABLED and is_image(url):
-            self.display_image_inline(line, offset)
+        if inline_images_enabled() and is_image(url):
+            self.display_image_inline(line)
 
         else:
             execute(f"{APPLICATION_HANDLER} {url}")
@@ -419,7 +1930,6 @@ class ContentWindow(urwid.ListBox):
     def back(self):
         history.back()
         self.gopher.crawl()
-        self.set_highlight(history.current_location.focus)
 
     def quit(self):
         widget = urwid.Filler(urwid.AttrMap(ExitOverlay(self.gopher), "exit_overlay"))
@@ -434,7 +1944,7 @@ class ContentWindow(urwid.ListBox):
         if sound_preview_thread is None:
             self.stop_sound()
 
-        self.gopher.crawl()
+        self.gopher.crawl(refresh=True)
 
     def ask(self, line):
         widget = urwid.Filler(
@@ -447,28 +1957,83 @@ class ContentWindow(urwid.ListBox):
         history.current_location.focus = self.current_highlight
         self.gopher.main_loop.widget = search_overlay
 
-    def open_image_preview(self, offset=0):
+    def open_image_preview(self):
         line = self.gopher.current_location_map[self.current_highlight]
 
-        if INLINE_IMAGES_ENABLED:
-            self.display_image_inline(line, offset=offset)
+        if inline_images_enabled():
+            self.display_image_inline(line)
 
         else:
-            file_path = self.gopher.download(line.location)
-            execute(f"{APPLICATION_HANDLER} {file_path}")
+            self.gopher.download(
+                line.location,
+                callback=lambda file_path: execute(f"{APPLICATION_HANDLER} {file_path}"))
 
     def close_image_preview(self):
-        global stop_image_preview_thread
-        stop_image_preview_thread = True
+        self.gopher.image_canvas.hide("image")
+        self.walker.set_preview(None)
 
-        highlighted_line = self.walker[self.current_highlight]
+        self.image_preview = None
+        self.image_preview_y = None
 
-        if hasattr(highlighted_line, "old_text"):
-            highlighted_line.base_widget.set_text(highlighted_line.old_text)
+    def filter_history(self):
+        widget = urwid.Filler(
+            urwid.AttrMap(HistoryFilterOverlay(self.gopher), "search_overlay"))
 
-        self.walker.pop(self.current_highlight + 1)
+        filter_overlay = urwid.AttrMap(urwid.Overlay(
+            widget, self.gopher.main_loop.widget,
+            "center", 50, valign="middle", height=3), "search_overlay")
 
-        self.image_preview = None
+        history.current_location.focus = self.current_highlight
+        self.gopher.main_loop.widget = filter_overlay
+
+    def search_visited(self):
+        widget = urwid.Filler(
+            urwid.AttrMap(VisitedSearchOverlay(self.gopher), "search_overlay"))
+
+        search_overlay = urwid.AttrMap(urwid.Overlay(
+            widget, self.gopher.main_loop.widget,
+            "center", 50, valign="middle", height=3), "search_overlay")
+
+        history.current_location.focus = self.current_highlight
+        self.gopher.main_loop.widget = search_overlay
+
+    def search_page(self):
+        if self.image_preview:
+            self.close_image_preview()
+
+        # built now, so that typing the query only has to scan it
+        self.gopher.current_location_map.text_index()
+
+        widget = urwid.Filler(
+            urwid.AttrMap(PageSearchOverlay(self.gopher, self.get_focus()[1] or 0), "search_overlay"))
+
+        search_overlay = urwid.AttrMap(urwid.Overlay(
+            widget, self.gopher.main_loop.widget,
+            "center", ("relative", 100), valign="bottom", height=3), "search_overlay")
+
+        self.gopher.main_loop.widget = search_overlay
+
+    def filter_bookmarks(self):
+        widget = urwid.Filler(
+            urwid.AttrMap(BookmarkFilterOverlay(self.gopher), "search_overlay"))
+
+        # kept clear of the list so the matches can be seen while typing
+        filter_overlay = urwid.AttrMap(urwid.Overlay(
+            widget, self.gopher.main_loop.widget,
+            "center", ("relative", 100), valign="bottom", height=3), "search_overlay")
+
+        self.gopher.main_loop.widget = filter_overlay
+
+    def show_downloads(self):
+        overlay = DownloadQueueOverlay(self.gopher)
+        self.gopher.download_queue_overlay = overlay
+
+        download_queue_overlay = urwid.AttrMap(urwid.Overlay(
+            urwid.AttrMap(overlay, "download_overlay"), self.gopher.main_loop.widget,
+            "center", ("relative", 80), valign="middle", height=("relative", 60)),
+            "download_overlay")
+
+        self.gopher.main_loop.widget = download_queue_overlay
 
     def add_bookmark(self):
         widget = urwid.Filler(
@@ -480,18 +2045,11 @@ class ContentWindow(urwid.ListBox):
 
         self.gopher.main_loop.widget = bookmark_overlay
 
-    def _count_hidden_lines(self, size):
-        focus = self.get_focus()[1]
-        middle, top, bottom = self.calculate_visible(size, True)
-        items_on_top = len(top[1])
-
-        return focus - items_on_top
-
     def mouse_event(self, size, event, button, col, row, focus):
         if not EXPERIMENTAL_MOUSE_NAVIGATION:
             return
 
-        if INLINE_IMAGES_ENABLED and not self.image_preview:
+        if inline_images_enabled():
             if event == "mouse press":
                 if button == 4.0:
                     self.base_widget._keypress_up(size)
@@ -507,7 +2065,7 @@ class ContentWindow(urwid.ListBox):
             self.set_highlight(focus)
 
         if event == "mouse press" and button == 1.0:  # left click
-            if INLINE_IMAGES_ENABLED and self.image_preview:
+            if inline_images_enabled() and self.image_preview:
                 self.close_image_preview()
 
             else:
@@ -517,10 +2075,10 @@ class ContentWindow(urwid.ListBox):
             line = self.gopher.current_location_map[self.current_highlight]
             focus = self.get_focus()[1]
 
-            if self.walker[focus].base_widget.selectable():
+            if self.walker.selectable(focus):
                 self.set_highlight(focus)
 
-            elif INLINE_IMAGES_ENABLED and self.image_preview:
+            elif inline_images_enabled() and self.image_preview:
                 self.close_image_preview()
 
             elif line.type == "htm":
@@ -530,12 +2088,13 @@ class ContentWindow(urwid.ListBox):
                 self.open_image_preview()
 
             elif line.type in ["snd", "vid"]:
-                if SOUND_PREVIEW_ENABLED:
+                if sound_preview_enabled():
                     self.play_sound(line)
 
                 else:
-                    file_path = self.gopher.download(line.location)
-                    execute(f"{APPLICATION_HANDLER} {file_path}")
+                    self.gopher.download(
+                        line.location,
+                        callback=lambda file_path: execute(f"{APPLICATION_HANDLER} {file_path}"))
 
             else:
                 self.forward(line)
@@ -543,45 +2102,66 @@ class ContentWindow(urwid.ListBox):
         super(ContentWindow, self).mouse_event(size, event, button, col, row, focus)
 
     def keypress(self, size, key):
+        # cursor movement comes first, it needs none of the lookups below
+        if key in ["j", "J", "up", "page up", "k", "K", "down", "page down"]:
+
+            if key in ["j", "down"]:
+                self.base_widget._keypress_down(size)
+            if key in ["J", "page down"]:
+                self.base_widget._keypress_page_down(size)
+
+            if key in ["k", "up"]:
+                self.base_widget._keypress_up(size)
+            if key in ["K", "page up"]:
+                self.base_widget._keypress_page_up(size)
+
+            self.scroll()
+            return
+
         line = None
 
         def _open(location):
             filename = f"{os.path.expanduser('~')}/Downloads/{location.url.rsplit('/')[-1]}"
 
+            def _opened(file_path):
+                self.gopher.status_bar.set_status(f"opening: {file_path}")
+                execute(f"{APPLICATION_HANDLER} {file_path}")
+
             if location.url.startswith("URL"):
                 url = location.url.replace("URL:", "")
-                self.gopher.download_http(url, filename)
+                self.gopher.download_http(url, filename, callback=_opened, background=True)
 
             else:
-                self.gopher.download(location, filename)
+                self.gopher.download(location, filename, callback=_opened, background=True)
 
-            self.gopher.status_bar.set_status(f"opening: {filename}")
-            execute(f"{APPLICATION_HANDLER} {filename}")
-
-        if history.current_location.walkable:
+        if history.current_location.walkable and self.current_highlight is not None:
             try:
                 line = self.gopher.current_location_map[self.current_highlight]
 
             except IndexError:
                 pass
 
-        if INLINE_IMAGES_ENABLED and self.image_preview:
-            if key in ["h", "left", "q", "esc"]:
-                self.close_image_preview()
+        previewed = self.image_preview and self.walker.preview[0] == self.current_highlight
 
-            if key in ["l", "right", "enter"]:
-                if line.type in ["img", "gif"]:
-                    self.gopher.status_bar.set_status(f"open: {self.image_preview[0]}")
-                    execute(f"{APPLICATION_HANDLER} {self.image_preview[0]}")
+        if self.image_preview and key in ["h", "left", "q", "esc"]:
+            self.close_image_preview()
 
-                if line.type == "htm":
-                    url = line.location.url.replace("URL:", "")
-                    execute(f"{APPLICATION_HANDLER} {url}")
+        elif previewed and key in ["l", "right", "enter"]:
+            if line.type in ["img", "gif"]:
+                self.gopher.status_bar.set_status(f"open: {self.image_preview[0]}")
+                execute(f"{APPLICATION_HANDLER} {self.image_preview[0]}")
+
+            if line.type == "htm":
+                url = line.location.url.replace("URL:", "")
+                execute(f"{APPLICATION_HANDLER} {url}")
 
         elif key in ["l", "right", "enter"]:
             if not line:
                 return
 
+            if self.image_preview:
+                self.close_image_preview()
+
             if not history.current_location.walkable:
                 return
 
@@ -589,25 +2169,19 @@ class ContentWindow(urwid.ListBox):
                 self.ask(line)
 
             elif line.type == "htm":
-                offset = self._count_hidden_lines(size)
-                self.forward_htm(line, offset)
+                self.forward_htm(line)
 
             elif line.type in ["img", "gif"]:
-                offset = self._count_hidden_lines(size)
-
-                try:
-                    self.open_image_preview(offset)
-
-                except Exception:
-                    self.close_image_preview(offset)
+                self.open_image_preview()
 
             elif line.type in ["snd", "vid"]:
-                if SOUND_PREVIEW_ENABLED:
+                if sound_preview_enabled():
                     self.play_sound(line)
 
                 else:
-                    file_path = self.gopher.download(line.location)
-                    execute(f"mplayer {file_path}")
+                    self.gopher.download(
+                        line.location,
+                        callback=lambda file_path: execute(f"mplayer {file_path}"))
 
             elif line.type in ["bin", "rtf", "pdf", "xml"]:
                 line = self.gopher.current_location_map[self.current_highlight]
@@ -623,6 +2197,15 @@ class ContentWindow(urwid.ListBox):
         elif key in ["r"]:
             self.refresh()
 
+        elif key in ["O"]:
+            self.gopher.toggle_offline()
+
+        elif key in ["t"]:
+            self.gopher.toggle_timings()
+
+        elif key in ["D"]:
+            self.show_downloads()
+
         elif key in ["s"]:
             self.stop_sound()
             self.refresh()
@@ -643,30 +2226,37 @@ class ContentWindow(urwid.ListBox):
             execute(command)
 
         elif key in ["i"]:
-            with open("/tmp/pherguson.log", "a+") as f:
-                for line in self.gopher.current_location_map:
-                    f.writelines(str(line))
+            if log.name not in log_writers:
+                self.gopher.status_bar.set_status("logging is off (start with --log FILE)", level="warning")
+                return
+
+            lines = self.gopher.current_location_map
+            log.info(
+                "dump %s: %s, %d rows\n%s", history.current_location, self.gopher.cache,
+                len(lines), "".join(str(line) for line in lines))
+
+            self.gopher.status_bar.set_status(f"dumped {len(lines)} rows to the log")
 
         elif key in ["tab", "ctrl l", "meta f", ":"]:
             self.gopher.window.focus_position = "header"
 
-        elif key in ["j", "J", "up", "page up", "k", "K", "down", "page down"]:
-
-            if key in ["j", "down"]:
-                self.base_widget._keypress_down(size)
-            if key in ["J", "page down"]:
-                self.base_widget._keypress_page_down(size)
+        elif key in ["/"]:
+            self.search_page()
 
-            if key in ["k", "up"]:
-                self.base_widget._keypress_up(size)
-            if key in ["K", "page up"]:
-                self.base_widget._keypress_page_up(size)
+        elif key in ["n", "N"] and self.search_query:
+            focus = self.get_focus()[1] or 0
+            if key == "n":
+                self.find(self.search_query, focus + 1)
 
-            self.scroll()
+            else:
+                self.find(self.search_query, focus, backward=True)
 
         elif key in ["h", "left", "backspace"]:
             self.back()
 
+        elif key in ["esc"]:
+            self.gopher.cancel()
+
         elif key in ["q", "ctrl c"]:
             self.quit()
 
@@ -700,140 +2290,260 @@ class ContentWindow(urwid.ListBox):
                 _open(location)
 
         elif key in ["B", "ctrl b"]:
-            content = [[""], ["i   B O O K M A R K S"], [""]]
-            with open(f"{HOME_DIRECTORY}/.config/pherguson/bookmarks") as file:
-                for line in file.read().split("\n"):
-                    if line == "":
-                        break
-
-                    content.append(line.split("\t"))
+            self.gopher.cancel()
 
+            history.current_location.focus = self.current_highlight
             history.show_bookmarks()
+            self.gopher.crawl()
+
+        elif key in ["H", "ctrl h"]:
+            history.current_location.focus = self.current_highlight
+            history.show_history()
+            self.gopher.crawl()
+
+        elif key in ["F"]:
+            self.search_visited()
+
+        elif key in ["f"] and history.current_location.history:
+            self.filter_history()
+
+        elif key in ["f"] and history.current_location.bookmarks:
+            self.filter_bookmarks()
+
+    def play_sound(self, line):
+        global sound_preview_thread
+        if sound_preview_thread:
+            return
+
+        self.gopher.download(line.location, callback=self._play_sound)
+
+    def _play_sound(self, filename):
+        global sound_preview_filename
+        global sound_preview_thread
+        sound_preview_filename = filename
 
-            lines = [self.gopher._parse_line(line) for line in content]
-            self.gopher.current_location_map = lines
+        command = f"mpv --really-quiet --input-ipc-server=/tmp/mpvsocket {filename}"
+        sound_preview_thread = subprocess.Popen(
+            command, stdout=subprocess.PIPE,
+            shell=True, preexec_fn=os.setsid)
+
+        global sound_preview_state
+        sound_preview_state = "PLAYING"
+        self.gopher.crawl()
+
+    def stop_sound(self):
+        global sound_preview_thread
+        if sound_preview_thread:
+            os.killpg(os.getpgid(sound_preview_thread.pid), signal.SIGTERM)
+            sound_preview_thread = None
+
+        global sound_preview_state
+        sound_preview_state = "STOPPED"
+
+    def display_image_inline(self, line):
+        url = line.location.url.replace("URL:", "")
+        menu, position = self.gopher.current_location_map, self.current_highlight
+
+        def _moved():
+            return self.gopher.current_location_map is not menu or self.current_highlight != position
+
+        def _display(filename):
+            if self.image_preview or _moved():
+                return
+
+            self.gopher.thumbnail(filename, callback=lambda thumbnail: _show(filename, *thumbnail))
+
+        def _show(filename, thumbnail_filename, thumbnail_width, thumbnail_height):
+            if self.image_preview or _moved():
+                return
+
+            self._display_image_inline(filename, thumbnail_filename, thumbnail_height)
+
+        if url.startswith("http"):
+            self.gopher.download_http(url, callback=_display)
+
+        else:
+            self.gopher.download(line.location, callback=_display)
+
+    def _display_image_inline(self, filename, thumbnail_filename, thumbnail_height):
+        self.image_preview = (filename, thumbnail_filename)
+        self.walker.set_preview(self.current_highlight, thumbnail_height)
 
-            self.clear()
-            self.set_content(lines, focus=0)
+    def _image_preview_row(self, size):
+        middle, top, bottom = self.calculate_visible(size, True)
+        if middle is None:
+            return None
+
+        position, pixels = self.walker.preview
+        offset, _, focus, focus_rows, _ = middle
+
+        # the preview box takes the bottom rows of the previewed entry
+        box_rows = int(pixels / DEFAULT_ROW_HEIGHT)
+
+        if focus == position:
+            return offset + focus_rows - box_rows
+
+        row = offset + focus_rows
+        for _, widget_position, rows in bottom[1]:
+            row += rows
+            if widget_position == position:
+                return row - box_rows
+
+        row = offset
+        for _, widget_position, rows in top[1]:
+            if widget_position == position:
+                return row - box_rows
+
+            row -= rows
+
+        return None
+
+    def _place_image_preview(self, size):
+        row = self._image_preview_row(size)
+
+        if row is None or row < 0:
+            y = None
+
+        else:
+            # leave a blank row between the entry and the image
+            y = self.gopher.header_pile.rows((size[0],)) + row + 1
+
+        if y == self.image_preview_y:
+            return
+
+        self.image_preview_y = y
+
+        if y is None:
+            self.gopher.image_canvas.hide("image")
+
+        else:
+            self.gopher.image_canvas.show("image", self.image_preview[1], 0, y)
+
+
+class SearchOverlay(urwid.Edit):
+    def __init__(self, gopher, line):
+        self.line = line
+        self.gopher = gopher
+        super(SearchOverlay, self).__init__(caption=" Search: ")
+
+    def keypress(self, size, key):
+        if key in ["enter"]:
+            query = self.get_edit_text().replace(" ", "_")
+
+            location = self.line.location
+            history.forward(Location(location.host, location.port, f"{location.url}\t{query}"))
+
+            self.gopher.main_loop.widget = self.gopher.window
+            self.gopher.crawl()
 
-        elif key in ["H", "ctrl h"]:
-            content = []
-            with open(f"{HOME_DIRECTORY}/.config/pherguson/history") as file:
-                for line in file.read().split("\n"):
-                    if line == "":
-                        break
+        if key in ["esc"]:
+            self.gopher.main_loop.widget = self.gopher.window
 
-                    content.append(line.split("\t"))
+        super(SearchOverlay, self).keypress(size, key)
 
-            content.append(["i"])
-            content.append(["i   H I S T O R Y"])
-            content.append(["i"])
 
-            history.show_history()
+class PageSearchOverlay(urwid.Edit):
+    def __init__(self, gopher, origin):
+        self.gopher = gopher
+        self.origin = origin
+        super(PageSearchOverlay, self).__init__(caption=" /")
 
-            lines = [self.gopher._parse_line(line) for line in content[::-1]]
-            self.gopher.current_location_map = lines
+    def restore_focus(self):
+        content_window = self.gopher.content_window
 
-            self.clear()
-            self.set_content(lines, focus=0)
+        if len(content_window.walker) > self.origin:
+            content_window.set_focus(self.origin)
+            content_window.scroll()
 
-    def play_sound(self, line):
-        global sound_preview_filename
-        global sound_preview_thread
-        if sound_preview_thread:
+    def keypress(self, size, key):
+        if key in ["enter"]:
+            self.gopher.content_window.search_query = self.get_edit_text()
+            self.gopher.main_loop.widget = self.gopher.window
             return
 
-        filename = self.gopher.download(line.location)
-        sound_preview_filename = filename
-
-        command = f"mpv --really-quiet --input-ipc-server=/tmp/mpvsocket {filename}"
-        sound_preview_thread = subprocess.Popen(
-            command, stdout=subprocess.PIPE,
-            shell=True, preexec_fn=os.setsid)
+        if key in ["esc"]:
+            self.gopher.main_loop.widget = self.gopher.window
+            self.restore_focus()
+            return
 
-        global sound_preview_state
-        sound_preview_state = "PLAYING"
-        self.refresh()
+        query = self.get_edit_text()
+        result = super(PageSearchOverlay, self).keypress(size, key)
 
-    def stop_sound(self):
-        global sound_preview_thread
-        if sound_preview_thread:
-            os.killpg(os.getpgid(sound_preview_thread.pid), signal.SIGTERM)
-            sound_preview_thread = None
+        # every keystroke searches again from where the search started
+        if self.get_edit_text() != query:
+            if self.get_edit_text():
+                self.gopher.content_window.find(self.get_edit_text(), self.origin)
 
-        global sound_preview_state
-        sound_preview_state = "STOPPED"
+            else:
+                self.restore_focus()
 
-    def display_image_inline(self, line, offset=0):
-        url = line.location.url.replace("URL:", "")
+        return result
 
-        if url.startswith("http"):
-            filename = self.gopher.download_http(url)
 
-        else:
-            filename = self.gopher.download(line.location)
+class VisitedSearchOverlay(urwid.Edit):
+    def __init__(self, gopher):
+        self.gopher = gopher
+        query = history.current_location.url if history.current_location.search else ""
+        super(VisitedSearchOverlay, self).__init__(caption=" Search visited pages: ", edit_text=query)
 
-        highlighted_line = self.walker[self.current_highlight]
-        highlighted_line.old_text = highlighted_line.base_widget.get_text()[0]
-        highlighted_line.base_widget.set_text(f"- {highlighted_line.old_text[2:]}")
+    def keypress(self, size, key):
+        if key in ["enter"] and self.get_edit_text().strip():
+            history.show_search(self.get_edit_text().strip())
 
-        img = Image.open(filename)
-        img.thumbnail(THUMBNAIL_SIZE)
+            self.gopher.main_loop.widget = self.gopher.window
+            self.gopher.crawl()
 
-        thumbnail_filename, thumbnail_extension = os.path.splitext(filename)
-        thumbnail_filename = f"{thumbnail_filename}-thumbnail{thumbnail_extension}"
+        if key in ["esc"]:
+            self.gopher.main_loop.widget = self.gopher.window
 
-        img.save(thumbnail_filename)
-        img.close()
+        super(VisitedSearchOverlay, self).keypress(size, key)
 
-        thumbnail = Image.open(thumbnail_filename)
-        thumbnail_width, thumbnail_height = thumbnail.size
-        thumbnail.close()
 
-        self.image_preview = (filename, thumbnail_filename)
-        self.walker.insert(self.current_highlight + 1, Box(thumbnail_height))
-        self.preview_image(thumbnail_filename, 0, self.current_highlight + 4 - offset)
+class HistoryFilterOverlay(urwid.Edit):
+    def __init__(self, gopher):
+        self.gopher = gopher
+        super(HistoryFilterOverlay, self).__init__(
+            caption=" Filter history: ", edit_text=history.current_location.url)
 
-    def preview_image(self, image_path, x, y):
-        def thread_function(image_path, x, y):
-            global stop_image_preview_thread
-            with ueberzug.Canvas() as canvas:
-                canvas.create_placement(
-                    "image", x=x, y=y, width=50,
-                    scaler=ueberzug.ScalerOption.FIT_CONTAIN.value,
-                    visibility=ueberzug.Visibility.VISIBLE,
-                    path=image_path)
+    def keypress(self, size, key):
+        if key in ["enter"]:
+            history.show_history(self.get_edit_text().strip())
 
-                while True:
-                    if stop_image_preview_thread:
-                        stop_image_preview_thread = False
-                        break
+            self.gopher.main_loop.widget = self.gopher.window
+            self.gopher.crawl()
 
-                    time.sleep(0.01)
+        if key in ["esc"]:
+            self.gopher.main_loop.widget = self.gopher.window
 
-        threading.Thread(target=thread_function, args=(image_path, x, y)).start()
+        super(HistoryFilterOverlay, self).keypress(size, key)
 
 
-class SearchOverlay(urwid.Edit):
-    def __init__(self, gopher, line):
-        self.line = line
+class BookmarkFilterOverlay(urwid.Edit):
+    def __init__(self, gopher):
         self.gopher = gopher
-        super(SearchOverlay, self).__init__(caption=" Search: ")
+        super(BookmarkFilterOverlay, self).__init__(
+            caption=" Filter bookmarks: ", edit_text=history.current_location.url)
+
+        self.set_edit_pos(len(self.edit_text))
 
     def keypress(self, size, key):
         if key in ["enter"]:
-            query = self.get_edit_text().replace(" ", "_")
-
-            self.line.location.url = f"{self.line.location.url}\t{query}"
-            history.forward(self.line.location)
-
             self.gopher.main_loop.widget = self.gopher.window
-            self.gopher.crawl()
+            return
 
         if key in ["esc"]:
+            self.set_edit_text("")
             self.gopher.main_loop.widget = self.gopher.window
 
-        super(SearchOverlay, self).keypress(size, key)
+        result = super(BookmarkFilterOverlay, self).keypress(size, key)
+
+        location = history.current_location
+        if location.bookmarks and location.url != self.get_edit_text():
+            location.url = self.get_edit_text()
+            location.focus = 3
+            self.gopher.show_bookmarks(location)
+
+        return result
 
 
 class BookmarkOverlay(urwid.Edit):
@@ -845,8 +2555,13 @@ class BookmarkOverlay(urwid.Edit):
         if key in ["enter"]:
             bookmark_name = self.get_edit_text()
 
-            with open(f"{HOME_DIRECTORY}/.config/pherguson/bookmarks", "a") as file:
-                file.write(f"{history.current_location.get_link(bookmark_name)}\n")
+            try:
+                history.bookmarks.add(history.current_location, bookmark_name)
+                self.gopher.status_bar.set_status(f"bookmarked {history.current_location}")
+
+            except OSError as e:
+                log.warning("bookmarks: could not save %s: %r", history.current_location, e)
+                self.gopher.status_bar.set_status(f"could not save the bookmark: {e}", level="error")
 
             self.gopher.main_loop.widget = self.gopher.window
 
@@ -867,12 +2582,14 @@ class DownloadOverlay(urwid.Edit):
 
     def keypress(self, size, key):
         if key in ["enter"]:
+            filename = os.path.expanduser(self.get_edit_text())
+
             if "URL" in self.location.url:
                 url = self.location.url.replace("URL:", "")
-                self.gopher.download_http(url, self.filename)
+                self.gopher.download_http(url, filename, background=True)
 
             else:
-                self.gopher.download(self.location, self.filename)
+                self.gopher.download(self.location, filename, background=True)
 
             self.gopher.main_loop.widget = self.gopher.window
 
@@ -882,6 +2599,69 @@ class DownloadOverlay(urwid.Edit):
         super(DownloadOverlay, self).keypress(size, key)
 
 
+class DownloadQueueOverlay(urwid.WidgetWrap):
+    def __init__(self, gopher):
+        self.gopher = gopher
+        self.walker = urwid.SimpleFocusListWalker([])
+        self.jobs = []
+
+        super(DownloadQueueOverlay, self).__init__(urwid.LineBox(
+            urwid.ListBox(self.walker),
+            title="downloads  c: cancel  r: retry  x: clear finished  esc: close"))
+
+        self.refresh()
+
+    def refresh(self):
+        jobs = list(self.gopher.downloads.jobs)
+
+        if jobs != self.jobs:
+            focus = self.walker.focus or 0
+
+            self.walker[:] = [
+                urwid.AttrMap(Selectable(str(job), "list"), None, focus_map="selection")
+                for job in jobs
+            ]
+            self.jobs = jobs
+
+            if self.walker:
+                self.walker.set_focus(min(focus, len(self.walker) - 1))
+
+        else:
+            for job, row in zip(jobs, self.walker):
+                row.base_widget.attr_map.base_widget.set_text(str(job))
+
+        self.gopher.redraw()
+
+    def close(self):
+        self.gopher.download_queue_overlay = None
+        self.gopher.main_loop.widget = self.gopher.window
+
+    def keypress(self, size, key):
+        job = self.jobs[self.walker.focus] if self.walker else None
+
+        if key in ["esc", "q", "D"]:
+            self.close()
+
+        elif key in ["c"] and job:
+            self.gopher.downloads.cancel(job)
+
+        elif key in ["r"] and job:
+            self.gopher.downloads.retry(job)
+
+        elif key in ["x"]:
+            self.gopher.downloads.clear()
+            self.refresh()
+
+        elif key in ["j"]:
+            return super(DownloadQueueOverlay, self).keypress(size, "down")
+
+        elif key in ["k"]:
+            return super(DownloadQueueOverlay, self).keypress(size, "up")
+
+        else:
+            return super(DownloadQueueOverlay, self).keypress(size, key)
+
+
 class ExitOverlay(urwid.Edit):
     def __init__(self, gopher):
         self.gopher = gopher
@@ -902,7 +2682,6 @@ class UrlBar(urwid.Columns):
     def __init__(self, gopher):
         self.gopher = gopher
         self.url_edit = urwid.AttrMap(urwid.Edit(caption=""), "url_bar")
-        self.scheme = "gopher://"
 
         content = [
             ("pack", urwid.AttrMap(urwid.Text("// "), "url_label")),
@@ -913,8 +2692,11 @@ class UrlBar(urwid.Columns):
 
     def set_url(self, history_location):
         port = f":{history_location.port}" if history_location.port != 70 else ""
+        # the item type goes before the selector, the way parse_url reads it back
+        char = "1" if history_location.walkable else "0"
+        selector = history_location.url.replace("\t", "?", 1)
 
-        edit_text = f"{history_location.host}{port}{history_location.url}"
+        edit_text = f"{history_location.host}{port}/{char}{selector}"
 
         self.url_edit.base_widget.set_edit_text(edit_text)
         self.url_edit.base_widget.set_edit_pos(len(edit_text))
@@ -924,18 +2706,17 @@ class UrlBar(urwid.Columns):
             self.gopher.window.focus_position = "body"
 
         if key == "enter":
-            url = self.url_edit.base_widget.get_edit_text()
-            if self.scheme not in url:
-                url = f"{self.scheme}{url}"
+            try:
+                location = parse_url(self.url_edit.base_widget.get_edit_text())
 
-            url = urlparse(url)
-            host, port = \
-                url.netloc.split(":") if ":" in url.netloc else (url.netloc, 70)
+            except Error as e:
+                self.gopher.status_bar.set_status(e.message, level="error")
+                return
 
             history.current_location.focus = \
                 self.gopher.content_window.current_highlight
 
-            history.forward(Location(host, port, url.path))
+            history.forward(location)
             self.gopher.crawl()
 
             self.gopher.window.focus_position = "body"
@@ -947,7 +2728,9 @@ class StatusBar(urwid.WidgetWrap):
     def __init__(self, gopher):
         self.gopher = gopher
 
-        self.attr = urwid.AttrMap(urwid.Text("status", align="right"), "ok")
+        self.text = urwid.Text("status", align="right")
+        self.attr = urwid.AttrMap(self.text, "ok")
+        self.level = "ok"
         super(StatusBar, self).__init__(self.attr)
 
     def set_status(self, message, level="ok", align="right"):
@@ -959,14 +2742,24 @@ class StatusBar(urwid.WidgetWrap):
 
             message = f"{sound_preview_message} {' ' * spacing} {message}"
 
-        self.attr.base_widget.set_text(message)
-        self.attr = urwid.AttrMap(urwid.Text(message, align=align), level)
-        super(StatusBar, self).__init__(self.attr)
+        if level != self.level:
+            self.attr.set_attr_map({None: level})
+            self.level = level
+
+        if align != self.text.align:
+            self.text.set_align_mode(align)
+
+        if message != self.text.text:
+            self.text.set_text(message)
+
+        self.gopher.redraw()
 
 
 class Gopher:
 
-    def __init__(self):
+    def __init__(self, offline=False, prefetch=False, cache_quota=CACHE_QUOTA,
+                 thumbnails=False, thumbnail_workers=THUMBNAIL_WORKERS,
+                 thumbnail_memory=THUMBNAIL_WORKER_MEMORY):
         self._url_bar = urwid.AttrMap(UrlBar(self), "url")
         self._content_window = urwid.AttrMap(ContentWindow(self), "list")
         self._status_bar = urwid.AttrMap(StatusBar(self), "status")
@@ -988,6 +2781,36 @@ class Gopher:
             focus_part="body"
         )
 
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.event_loop = EventLoop(loop=self.loop)
+
+        self.task = None
+        self.task_location = None
+        self.displayed_location = None
+        self.current_location_map = Menu()
+        self.menu_cache = MenuCache()
+        self.cache = Cache(quota=cache_quota)
+        self.search_index = SearchIndex(self.cache.cache_directory)
+        self.thumbnails = {}
+        self.thumbnail_generator = None
+        if thumbnails and inline_images_enabled():
+            self.thumbnail_generator = ThumbnailGenerator(
+                self, workers=thumbnail_workers, memory_limit=thumbnail_memory)
+        self.offline = offline
+        self.prefetcher = Prefetcher(self) if prefetch else None
+
+        self.downloads = DownloadManager(self.loop, on_change=self._download_changed)
+        self.foreground_job = None
+        self.download_queue_overlay = None
+        self.image_canvas = ImageCanvas()
+
+        self.metrics = Metrics()
+        self.show_timings = False
+        self.rendering = None
+
+        self.history_cursor = None
+
         self.crawl()
 
     @property
@@ -1002,170 +2825,513 @@ class Gopher:
     def status_bar(self):
         return self._status_bar.base_widget
 
-    def _get_socket(self, location):
-        crlf = "\r\n"
+    def _cancel(self):
+        cancelled = False
+
+        if self.foreground_job is not None and self.foreground_job.pending:
+            self.downloads.cancel(self.foreground_job)
+            cancelled = True
+
+        self.foreground_job = None
+
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            if self.task_location is not None and self.task_location is not self.displayed_location:
+                history.discard(self.task_location)
+
+            cancelled = True
+
+        return cancelled
+
+    def cancel(self):
+        if self._cancel():
+            self.url_bar.set_url(history.current_location)
+            self.status_bar.set_status("cancelled", level="warning")
 
-        skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        skt.settimeout(10)
+    def _spawn(self, coroutine, location=None):
+        self._cancel()
 
+        self.task = self.loop.create_task(coroutine)
+        self.task_location = location
+
+        return self.task
+
+    def _download_changed(self, job):
+        if self.download_queue_overlay:
+            self.download_queue_overlay.refresh()
+
+        if job.state == DownloadJob.ACTIVE:
+            if job is self.foreground_job:
+                self.status_bar.set_status(str(job.transfer), level="loading")
+
+        elif job.state == DownloadJob.DONE:
+            self.status_bar.set_status(f"downloaded: {shorten(job.file_path)}")
+
+        elif job.state == DownloadJob.FAILED:
+            self.status_bar.set_status(job.error, level="error")
+
+    def _submit_download(self, job, callback, background):
+        if background:
+            self.status_bar.set_status(
+                f"queued: {job.name} (D to show downloads)", level="loading")
+
+            return self.downloads.submit(job, callback)
+
+        if self.foreground_job is not None and self.foreground_job.pending:
+            self.downloads.cancel(self.foreground_job)
+
+        self.status_bar.set_status(f"downloading: {job.name}", level="loading")
+        self.foreground_job = self.downloads.submit(job, callback)
+
+        return self.foreground_job
+
+    def thumbnail(self, filename, callback):
+        thumbnail = self.thumbnails.get(filename)
+        if thumbnail is not None:
+            callback(thumbnail)
+            return
+
+        self.status_bar.set_status(f"decoding: {shorten(filename)}", level="loading")
+        self.loop.create_task(self._thumbnail(filename, callback))
+
+    async def _thumbnail(self, filename, callback):
         try:
-            with open("/tmp/pherguson.log", "w") as file:
-                file.write(f"{location.host} {location.port}\n")
+            thumbnail = await self.loop.run_in_executor(
+                None, self.cache.store_thumbnail, filename)
 
-            skt.connect((location.host, location.port))
-            skt.send(str.encode(location.url) + str.encode(crlf))
-            skt.shutdown(1)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            self.status_bar.set_status(f"error: {e}", level="error")
+            return
 
-            return skt
+        self.thumbnails[filename] = thumbnail
+        self.status_bar.set_status(shorten(filename))
 
-        except (ConnectionRefusedError, socket.gaierror, OSError):
-            raise Error(f"error connecting to {location.host}:{location.port}")
+        callback(thumbnail)
 
-    def get_content(self, location):
-        sock = self._get_socket(location)
-        file = sock.makefile("r")
+    def _cached(self, key, url, callback):
+        file_path, _ = self.cache.lookup(key)
+        if file_path is None:
+            return None
 
-        lines = []
-        while True:
-            try:
-                line = file.readline()
-                if not line or line == "":
-                    break
+        self.status_bar.set_status(f"cached: {shorten(file_path)}")
 
-                lines.append([part.strip("\n") for part in line.split("\t")])
+        if callback:
+            callback(file_path)
 
-            except Exception as e:
-                self.status_bar.set_status(str(e), level="warning")
+        return file_path
 
-        sock.close()
+    async def _store(self, download, key, url, job):
+        file_path = await download
+        self.cache.add(key, file_path, url, job.transfer.received)
 
-        self.url_bar.set_url(history.current_location)
-        return lines
+        return file_path
 
-    def download_http(self, url, file_path=None):
+    def download_http(self, url, file_path=None, callback=None, background=False):
         parsed_url = urlparse(url)
-        filename = url.split("/")[-1]
 
+        key = None
         if not file_path:
-            download_directory = Cache.get_cache_directory(parsed_url.netloc)
+            key, file_path = self.cache.entry(url=url)
+            if self._cached(key, url, callback):
+                return
 
-            file_path = f"{download_directory}/{filename}"
+            self.cache.prepare(file_path)
 
-            if Cache.file_exists(file_path):
-                self.status_bar.set_status(
-                    f"cached: {file_path.replace(HOME_DIRECTORY, '~')}")
-                return file_path
+        if self.offline:
+            self.status_bar.set_status(f"offline: {url} is not cached", level="error")
+            return
 
-        self.status_bar.set_status(
-            f"downloading: {url}", level="loading")
-        response = requests.get(url, stream=True)
+        def _run(job):
+            download = self._download_http(url, file_path, job)
+            return self._store(download, key, url, job) if key else download
 
-        if response.status_code == 200:
-            response.raw.decode_content = True
+        job = DownloadJob(url, parsed_url.netloc, file_path, _run)
 
-            with open(file_path, "wb") as f:
-                shutil.copyfileobj(response.raw, f)
+        return self._submit_download(job, callback, background)
 
+    async def _download_http(self, url, file_path, job):
+        cancelled = threading.Event()
+        timing = Timing("download", url, job.host)
+
+        try:
+            file_path = await self.loop.run_in_executor(
+                self.downloads.executor, self._download_http_blocking,
+                url, file_path, job, cancelled, timing)
+
+        finally:
+            cancelled.set()
+
+        self._record(timing)
         return file_path
 
-    def download(self, location, file_path=None):
-        filename = location.url.split("/")[-1]
+    def _download_http_blocking(self, url, file_path, job, cancelled, timing):
+        return fetch_http(
+            url, file_path, job.transfer, cancelled,
+            progress=lambda: self.loop.call_soon_threadsafe(self.downloads.changed, job),
+            timing=timing)
+
+    def download(self, location, file_path=None, callback=None, background=False):
+        url = f"gopher://{location.host}:{location.port}{location.url}"
+
+        key = None
         if not file_path:
-            download_directory = Cache.get_cache_directory(location.host)
+            key, file_path = self.cache.entry(location=location)
+            if self._cached(key, url, callback):
+                return
 
-            file_path = f"{download_directory}/{filename}"
-            if Cache.file_exists(file_path):
-                self.status_bar.set_status(
-                    f"cached: {file_path.replace(HOME_DIRECTORY, '~')}")
-                return file_path
+            self.cache.prepare(file_path)
 
-        self.status_bar.set_status(
-            f"downloading: gopher://{location.host}{location.url}",
-            level="loading")
+        if self.offline:
+            self.status_bar.set_status(f"offline: {location} is not cached", level="error")
+            return
+
+        def _run(job):
+            download = self._download(location, file_path, job)
+            return self._store(download, key, url, job) if key else download
 
-        s = self._get_socket(location)
-        f = s.makefile("rb")
+        job = DownloadJob(
+            f"gopher://{location.host}{location.url}", location.host, file_path, _run)
 
-        with open(file_path, "wb") as file:
-            file.write(f.read())
+        return self._submit_download(job, callback, background)
 
-        s.close()
+    async def _download(self, location, file_path, job):
+        timing = Timing("download", job.name, location.host)
 
+        await get_file(
+            location, file_path, job.transfer,
+            progress=lambda: self.downloads.changed(job), timing=timing)
+
+        self._record(timing)
         return file_path
 
-    def _parse_line(self, line):
-        text = line[0] if len(line) > 0 else ""
-        url = line[1] if len(line) > 1 else ""
-        host = line[2] if len(line) > 2 else ""
+    def toggle_offline(self):
+        self.offline = not self.offline
+        self.status_bar.set_status(
+            f"offline mode: {'on' if self.offline else 'off'}",
+            level="warning" if self.offline else "ok")
+
+    def crawl(self, refresh=False):
+        location = history.current_location
+        self.url_bar.set_url(location)
+
+        if self.prefetcher:
+            self.prefetcher.cancel()
+
+        if location.history:
+            self.show_history(location)
+            return
+
+        if location.bookmarks:
+            self.show_bookmarks(location)
+            return
+
+        if location.search:
+            self.show_search(location)
+            return
+
+        lines = None if refresh and not self.offline else self.menu_cache.get(location)
+        if lines is not None:
+            log.info("open %s (memory cache)", location)
+
+            if self.prefetcher:
+                self.prefetcher.claim(location)
+
+            self._cancel()
+            self._display(location, lines)
+            self.content_window.finish_content()
+            return
+
+        rows, fetched_at = (None, None) if refresh and not self.offline else self.cache.load_menu(location)
+        if rows is not None:
+            log.info("open %s (disk cache)", location)
+            self._cancel()
+
+            lines = Menu(rows, location.walkable)
+            self._display(location, lines)
+            self.content_window.finish_content()
+            self.menu_cache.put(location, lines)
+
+            age = format_age(time.time() - fetched_at)
+            if self.offline:
+                self.status_bar.set_status(f"{location} (offline, cached {age} ago)", level="warning")
+
+            else:
+                self.status_bar.set_status(f"{location} (cached {age} ago, revalidating)", level="loading")
+                self._spawn(self._revalidate(location, rows), location)
+
+            return
+
+        if self.offline:
+            log.info("open %s: not cached, offline", location)
+            self._cancel()
+            history.discard(location)
+
+            self.url_bar.set_url(history.current_location)
+            self.status_bar.set_status(f"offline: {location} is not cached", level="error")
+            return
+
+        log.info("open %s", location)
+
+        if self.displayed_location is None:
+            # nothing shown yet: the landing page until the start page loads, without
+            # a cursor, which would set the focus the start page opens with
+            self.current_location_map = Menu(LANDING_PAGE)
+            self.content_window.walker.set_lines(self.current_location_map)
+
+        self.status_bar.set_status(f"{location} (esc to cancel)", level="loading")
+
+        self._spawn(self._crawl(location), location)
+
+    def _history_rows(self, visits):
+        rows = []
+        for _, visited_at, host, port, selector, walkable in visits:
+            location = Location(host, port, selector, walkable=bool(walkable))
+            timestamp = datetime.datetime.fromtimestamp(visited_at).strftime("%Y-%m-%d %H:%M:%S")
+
+            rows.append(location.get_link(name=f"{timestamp} {location}").split("\t"))
+
+        return rows
+
+    def show_history(self, location):
+        self._cancel()
+
+        visits = history.store.page(location.url)
+        self.history_cursor = visits[-1][0] if len(visits) == HISTORY_PAGE_SIZE else None
+
+        rows = [["i"], [f"i   H I S T O R Y{f': {location.url}' if location.url else ''}"], ["i"]]
+        rows.extend(self._history_rows(visits))
+
+        self._display(location, Menu(rows))
+        self.content_window.finish_content()
+
+        self.status_bar.set_status("history (f to filter)")
+
+    def show_bookmarks(self, location):
+        self._cancel()
+
+        bookmarks = history.bookmarks
+        bookmarks.load()
+        matches = bookmarks.filter(location.url)
+
+        lines = Menu([["i"], [f"i   B O O K M A R K S{f': {location.url}' if location.url else ''}"], ["i"]])
+        lines.extend_from(bookmarks.menu, matches)
+
+        self._display(location, lines)
+        self.content_window.finish_content()
+
+        self.status_bar.set_status(f"bookmarks: {len(matches)} of {len(bookmarks)} (f to filter)")
+
+    def show_search(self, location):
+        self._cancel()
+
+        started = time.monotonic()
+        pages = self.search_index.search(location.url)
+        elapsed = time.monotonic() - started
+
+        rows = [["i"], [f"i   S E A R C H: {location.url}"], ["i"]]
+        for host, port, selector, walkable, title, snippet in pages:
+            page = Location(host, port, selector, walkable=bool(walkable))
+
+            rows.append(page.get_link(name=f"{title} ({page})").split("\t"))
+            rows.append([f"i    {' '.join(snippet.split())}"])
+
+        self._display(location, Menu(rows))
+        self.content_window.finish_content()
+
+        if not self.search_index.available:
+            self.status_bar.set_status("search: sqlite has no fts5, nothing is indexed", level="error")
+
+        else:
+            self.status_bar.set_status(
+                f"{len(pages)}{'+' if len(pages) == SEARCH_RESULTS else ''} pages "
+                f"matching {location.url!r} ({elapsed * 1000:.1f} ms)")
+
+    def more_history(self):
+        if self.history_cursor is None:
+            return
+
+        location = self.displayed_location
+        visits = history.store.page(location.url, before=self.history_cursor)
+        self.history_cursor = visits[-1][0] if len(visits) == HISTORY_PAGE_SIZE else None
+
+        self.content_window.append_content(self._history_rows(visits))
+
+    def _display(self, location, lines):
+        if self.thumbnail_generator:
+            self.thumbnail_generator.cancel()
+
+        self.current_location_map = lines
+        self.displayed_location = location
+
+        self.content_window.clear()
+        self.status_bar.set_status(f"{location}")
+        self.content_window.set_content(lines, location.focus)
+
+    def _store_menu(self, location, rows):
+        self.loop.run_in_executor(None, self.cache.store_menu, location, rows)
+        self.search_index.add(location, rows)
+
+    async def _revalidate(self, location, cached_rows):
+        timing = Timing("menu", str(location), location.host)
+        rows = []
+
         try:
-            port = int(line[3]) if len(line) > 3 else 70
+            async for content in get_content(location, timing):
+                rows.extend(content)
 
-        except Exception:
-            port = 70
+            log.info("revalidated %s: %s", location, "unchanged" if rows == cached_rows else "changed")
+
+            if rows != cached_rows:
+                location.focus = self.content_window.current_highlight
+
+                with timing.stage("parse"):
+                    lines = Menu(rows, location.walkable)
 
-        with open("/tmp/pherguson.log", "w") as file:
-            file.write((str(history.current_location.url)))
+                self._display(location, lines)
+                self.content_window.finish_content()
+                self.menu_cache.put(location, lines)
+                self._record_after_render(timing)
 
-        line_type = "inf"
-        if history.current_location.walkable and len(text) > 0:
-            line_type = TYPE_MAP.get(text[0], "inf")
-            text = text[1:]
+            else:
+                self.status_bar.set_status(f"{location}")
+                self._record(timing)
+
+            self._store_menu(location, rows)
+
+        except Error as e:
+            self.status_bar.set_status(f"{e.message} (showing cached copy)", level="warning")
 
-        return Line(line_type, text, Location(host, port, url))
+        except Exception as e:
+            # a failing page must not take the main loop down with it
+            log.exception("revalidating %s failed", location)
+            self.status_bar.set_status(f"error: {e!r}", level="error")
+
+    async def _crawl(self, location):
+        timing = Timing("menu", str(location), location.host)
+        displayed = False
+        rows = []
 
-    def crawl(self):
         try:
-            location = history.current_location
-            self.status_bar.set_status(f"{location}", level="loading")
-            content = self.get_content(location)
+            async for content in get_content(location, timing):
+                rows.extend(content)
+                if not displayed:
+                    with timing.stage("parse"):
+                        lines = Menu(content, location.walkable)
+
+                    self._display(location, lines)
+                    displayed = True
+
+                else:
+                    with timing.stage("parse"):
+                        self.content_window.append_content(content)
+
+            if not displayed:
+                self._display(location, Menu(walkable=location.walkable))
 
-            lines = [self._parse_line(line) for line in content]
-            self.current_location_map = lines
+            log.info("loaded %s: %d rows", location, len(rows))
 
-            self.content_window.clear()
-            self.status_bar.set_status(f"{location}")
-            self.content_window.set_content(lines, location.focus)
+            self.content_window.finish_content()
+            self.menu_cache.put(location, self.current_location_map)
+            self._record_after_render(timing)
+
+            self._store_menu(location, rows)
 
         except Error as e:
-            self.status_bar.set_status(e.message, level="error")
+            self._crawl_failed(location, e.message)
+
+        except Exception as e:
+            # a failing page must not take the main loop down with it
+            log.exception("loading %s failed", location)
+            self._crawl_failed(location, f"error: {e!r}")
+
+    def _crawl_failed(self, location, message):
+        if location is not self.displayed_location:
+            history.discard(location)
+
+        self.url_bar.set_url(history.current_location)
+        self.status_bar.set_status(message, level="error")
 
-            history.back()
-            self.crawl()
+    def _record(self, timing):
+        self.metrics.record(timing)
 
-    def refresh_screen(self, main_loop, stop_event, message_queue):
-        while not stop_event.wait(timeout=0.5):
-            message_queue.put(time.strftime('time %X'))
-            main_loop.draw_screen()
+        if self.show_timings:
+            self.status_bar.set_status(self.metrics.describe(timing))
 
-    def run(self):
-        screen = urwid.raw_display.Screen()
-        screen.set_terminal_properties(256)
+    def _record_after_render(self, timing):
+        if self.rendering is not None:
+            self._record(self.rendering)
 
-        stop_event = threading.Event()
-        message_queue = queue.Queue()
+        self.rendering = timing
+        self.redraw()
+
+    def rendered(self, seconds):
+        if self.rendering is None:
+            return
+
+        timing, self.rendering = self.rendering, None
+        timing.add("render", seconds)
+        self._record(timing)
+
+    def toggle_timings(self):
+        self.show_timings = not self.show_timings
+
+        if not self.show_timings:
+            self.status_bar.set_status(f"{history.current_location}")
+
+        elif self.metrics.last is not None:
+            self.status_bar.set_status(self.metrics.describe(self.metrics.last))
+
+        else:
+            self.status_bar.set_status("timings: on")
+
+    def redraw(self):
+        self.event_loop.request_idle()
+
+    def run(self, screen=None):
+        if screen is None:
+            screen = urwid.raw_display.Screen()
+            screen.set_terminal_properties(256)
 
         self.main_loop = urwid.MainLoop(
-            self.window, palette=COLOR_MAP, screen=screen)
+            self.window, palette=COLOR_MAP, screen=screen,
+            event_loop=self.event_loop)
 
         try:
-            self.refresh_screen_thread = threading.Thread(
-                target=self.refresh_screen,
-                args=[self.main_loop, stop_event, message_queue])
-
-            self.refresh_screen_thread.start()
-            self.main_loop.run()
+            with self.main_loop.start():
+                # the start page (cached) or the landing page is painted before the
+                # event loop runs, so before the fetches queued by crawl() start
+                self.main_loop.draw_screen()
+                self.event_loop.run()
 
         except (urwid.ExitMainLoop, KeyboardInterrupt):
-            global stop_image_preview_thread
-            stop_image_preview_thread = True
+            pass
+
+        self.image_canvas.stop()
+
+        global sound_preview_thread
+        if sound_preview_thread:
+            os.killpg(os.getpgid(sound_preview_thread.pid), signal.SIGTERM)
+            sound_preview_thread = None
+
+        if self.task:
+            self.task.cancel()
+
+        if self.prefetcher:
+            self.prefetcher.cancel()
+
+        self.downloads.shutdown()
 
-            global sound_preview_thread
-            if sound_preview_thread:
-                os.killpg(os.getpgid(sound_preview_thread.pid), signal.SIGTERM)
-                sound_preview_thread = None
+        if self.thumbnail_generator:
+            self.thumbnail_generator.shutdown()
+
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+
+        history.store.close()
+        self.search_index.close()
+
+        log.info("exit")
+        stop_logging()
 
-        stop_event.set()
         for thread in threading.enumerate():
             if thread != threading.current_thread():
                 thread.join()
@@ -1173,5 +3339,34 @@ class Gopher:
         exit(0)
 
 
+def main(arguments=None, screen=None):
+    arguments = parse_arguments(arguments)
+
+    if arguments.log:
+        start_logging(arguments.log, arguments.log_level)
+
+    if arguments.metrics:
+        start_logging(arguments.metrics, logger=metrics_log, format="%(message)s")
+
+    try:
+        location = parse_url(arguments.url) if arguments.url else Location("gopher.flatline.ltd", 70, "/")
+
+    except Error as e:
+        print(f"pherguson: {e.message}", file=sys.stderr)
+        return 1
+
+    history.forward(location)
+
+    Gopher(
+        offline=arguments.offline,
+        prefetch=arguments.prefetch,
+        cache_quota=arguments.cache_quota * 1024 * 1024,
+        thumbnails=arguments.thumbnails,
+        thumbnail_workers=arguments.thumbnail_workers,
+        thumbnail_memory=arguments.thumbnail_memory * 1024 * 1024,
+    ).run(screen)
+
+
 if __name__ == "__main__":
-    Gopher().run()
+    multiprocessing.freeze_support()
+    sys.exit(main())